@@ -0,0 +1,361 @@
+"""
+Blob Caches
+
+Two read-through tiers in front of blob storage (storage.py), both keyed by file id and
+bounded in bytes with least-recently-used eviction:
+
+MemoryCache holds small blobs (thumbnails, covers) in process memory, so
+repeated hits skip both MongoDB and the disk.
+
+DiskCache keeps larger hot GridFS files on local disk. A miss copies the
+file out of GridFS once; later requests are served from disk (FileResponse, i.e.
+sendfile where the server supports it) without touching MongoDB. Files
+are sharded into subdirectories by the last two characters of their id,
+with a small JSON sidecar holding the metadata the response needs.
+Several API workers may share one directory: each keeps its own LRU index
+and treats a file another worker evicted as a miss.
+
+Settings (environment):
+    IMAGE_MEMORY_CACHE_MAX_BYTES  memory tier size cap; 0 disables it (default: 64 MiB)
+    IMAGE_MEMORY_CACHE_MAX_ITEM   largest blob kept in memory (default: 256 KiB)
+    IMAGE_DISK_CACHE_DIR          cache directory (default: <tmp>/flamesblue-image-cache)
+    IMAGE_DISK_CACHE_MAX_BYTES    disk tier size cap; 0 disables it (default: 1 GiB)
+    IMAGE_DISK_CACHE_MAX_ITEM     largest file worth caching on disk (default: 64 MiB)
+"""
+
+import io
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Awaitable, Callable, Iterable, Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+from storage import FileBlob
+
+IMAGE_MEMORY_CACHE_MAX_BYTES = int(os.getenv("IMAGE_MEMORY_CACHE_MAX_BYTES", str(64 * 1024 ** 2)))
+IMAGE_MEMORY_CACHE_MAX_ITEM = int(os.getenv("IMAGE_MEMORY_CACHE_MAX_ITEM", str(256 * 1024)))
+IMAGE_DISK_CACHE_DIR = os.getenv("IMAGE_DISK_CACHE_DIR", os.path.join(tempfile.gettempdir(), "flamesblue-image-cache"))
+IMAGE_DISK_CACHE_MAX_BYTES = int(os.getenv("IMAGE_DISK_CACHE_MAX_BYTES", str(1024 ** 3)))
+IMAGE_DISK_CACHE_MAX_ITEM = int(os.getenv("IMAGE_DISK_CACHE_MAX_ITEM", str(64 * 1024 ** 2)))
+
+_COPY_CHUNK = 1024 * 1024
+
+
+def blob_meta(blob) -> dict:
+    """The GridOut attributes responses use, as a JSON-friendly dict"""
+    return {
+        "file_id": str(blob._id),
+        "length": blob.length,
+        "content_type": blob.content_type,
+        "md5": getattr(blob, "md5", None),
+        "upload_date": blob.upload_date.isoformat() if blob.upload_date else None,
+    }
+
+
+class MemoryBlob:
+    """Cached bytes with the attributes of a GridOut that responses use"""
+
+    def __init__(self, data: bytes, meta: dict):
+        self.data = data
+        self._id = meta["file_id"]
+        self.length = meta["length"]
+        self.content_type = meta.get("content_type")
+        self.md5 = meta.get("md5")
+        self.upload_date = datetime.fromisoformat(meta["upload_date"]) if meta.get("upload_date") else None
+        self._buf = io.BytesIO(data)
+
+    def seek(self, pos: int):
+        self._buf.seek(pos)
+
+    def read(self, size: int = -1) -> bytes:
+        return self._buf.read(size)
+
+    def close(self):
+        pass
+
+
+class MemoryCache:
+    """Byte-bounded LRU of small blobs held in process memory"""
+
+    def __init__(self, max_bytes: int = IMAGE_MEMORY_CACHE_MAX_BYTES, max_item: int = IMAGE_MEMORY_CACHE_MAX_ITEM):
+        self.max_bytes = max_bytes
+        self.max_item = min(max_item, max_bytes)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, file_id: str) -> Optional[MemoryBlob]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(file_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(file_id)
+            self.hits += 1
+        return MemoryBlob(*entry)
+
+    def put(self, data: bytes, meta: dict) -> MemoryBlob:
+        file_id = meta["file_id"]
+        if self.enabled and len(data) <= self.max_item:
+            with self._lock:
+                if file_id in self._entries:
+                    self._bytes -= len(self._entries.pop(file_id)[0])
+                self._entries[file_id] = (data, meta)
+                self._bytes += len(data)
+                while self._bytes > self.max_bytes:
+                    _, (evicted, _) = self._entries.popitem(last=False)
+                    self._bytes -= len(evicted)
+                    self.evictions += 1
+        return MemoryBlob(data, meta)
+
+    def discard(self, file_ids: Iterable[str]):
+        with self._lock:
+            for file_id in map(str, file_ids):
+                if file_id in self._entries:
+                    self._bytes -= len(self._entries.pop(file_id)[0])
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "max_item": self.max_item,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class DiskCache:
+    """Byte-bounded LRU of files on local disk"""
+
+    def __init__(self, directory: str = IMAGE_DISK_CACHE_DIR, max_bytes: int = IMAGE_DISK_CACHE_MAX_BYTES, max_item: int = IMAGE_DISK_CACHE_MAX_ITEM):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_item = min(max_item, max_bytes)
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _paths(self, file_id: str):
+        path = os.path.join(self.directory, file_id[-2:], file_id)
+        return path, path + ".json"
+
+    def _load(self):
+        """Index what a previous run left on disk, oldest first"""
+        found = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".json") or name.startswith("."):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                found.append((st.st_mtime, name, st.st_size))
+        for _, file_id, size in sorted(found):
+            self._entries[file_id] = size
+            self._bytes += size
+        self._loaded = True
+        self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            file_id, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            self._unlink(file_id)
+
+    def _unlink(self, file_id: str):
+        for p in self._paths(file_id):
+            try:
+                os.unlink(p)
+            except OSError:
+                pass
+
+    def get(self, file_id: str) -> Optional[FileBlob]:
+        if not self.enabled:
+            return None
+        path, meta_path = self._paths(file_id)
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            try:
+                with open(meta_path) as fh:
+                    meta = json.load(fh)
+                os.utime(path)
+            except (OSError, ValueError):
+                # Evicted by another worker (or never cached)
+                if file_id in self._entries:
+                    self._bytes -= self._entries.pop(file_id)
+                self.misses += 1
+                return None
+            if file_id not in self._entries:
+                self._entries[file_id] = meta["length"]
+                self._bytes += meta["length"]
+                self._evict()
+            self._entries.move_to_end(file_id)
+            self.hits += 1
+        return FileBlob(path, meta)
+
+    def fill(self, grid_out):
+        """Copy a GridOut into the cache and return the cached copy; returns the GridOut itself when it is not cacheable"""
+        if not self.enabled or grid_out.length > self.max_item:
+            return grid_out
+        meta = blob_meta(grid_out)
+        file_id = meta["file_id"]
+        path, meta_path = self._paths(file_id)
+        tmp = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".fill-")
+            with os.fdopen(fd, "wb") as out:
+                while True:
+                    chunk = grid_out.read(_COPY_CHUNK)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+            with open(meta_path, "w") as fh:
+                json.dump(meta, fh)
+            os.replace(tmp, path)
+        except OSError:
+            # Disk full or unwritable: serve straight from storage
+            if tmp and os.path.exists(tmp):
+                os.unlink(tmp)
+            grid_out.seek(0)
+            return grid_out
+        grid_out.close()
+        self._admit(file_id, meta["length"])
+        return FileBlob(path, meta)
+
+    async def afill(self, blob):
+        """fill() for an AsyncBlob: chunks are read without blocking, local disk writes run in the threadpool"""
+        if not self.enabled or blob.length > self.max_item:
+            return blob
+        meta = blob_meta(blob)
+        file_id = meta["file_id"]
+        path, meta_path = self._paths(file_id)
+        tmp = out = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".fill-")
+            out = os.fdopen(fd, "wb")
+            while True:
+                chunk = await blob.read(_COPY_CHUNK)
+                if not chunk:
+                    break
+                await run_in_threadpool(out.write, chunk)
+            out.close()
+            with open(meta_path, "w") as fh:
+                json.dump(meta, fh)
+            os.replace(tmp, path)
+        except OSError:
+            if out is not None:
+                out.close()
+            if tmp and os.path.exists(tmp):
+                os.unlink(tmp)
+            blob.seek(0)
+            return blob
+        blob.close()
+        await run_in_threadpool(self._admit, file_id, meta["length"])
+        return FileBlob(path, meta)
+
+    def _admit(self, file_id: str, length: int):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if file_id in self._entries:
+                self._bytes -= self._entries.pop(file_id)
+            self._entries[file_id] = length
+            self._bytes += length
+            self._evict()
+
+    def discard(self, file_ids: Iterable[str]):
+        """Drop files that were deleted from storage"""
+        if not self.enabled:
+            return
+        with self._lock:
+            for file_id in map(str, file_ids):
+                if file_id in self._entries:
+                    self._bytes -= self._entries.pop(file_id)
+                self._unlink(file_id)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+memory_cache = MemoryCache()
+disk_cache = DiskCache()
+
+
+def open_cached(file_id: str, load: Callable):
+    """Blob for file_id from the memory tier, then the disk tier, then load() (a store's blob).
+
+    Small blobs are promoted into memory; larger ones are filled into the disk
+    tier unless they already are local files (the local backend).
+    """
+    blob = memory_cache.get(file_id)
+    if blob is not None:
+        return blob
+    blob = disk_cache.get(file_id) or load()
+    if memory_cache.enabled and blob.length <= memory_cache.max_item:
+        try:
+            return memory_cache.put(blob.read(), blob_meta(blob))
+        finally:
+            blob.close()
+    return blob if isinstance(blob, FileBlob) else disk_cache.fill(blob)
+
+
+async def open_cached_async(file_id: str, load: Callable[[], Awaitable]):
+    """open_cached() for request handlers: load() is awaited (BlobStore.aopen) and disk work runs in the threadpool"""
+    blob = memory_cache.get(file_id)
+    if blob is not None:
+        return blob
+    blob = await run_in_threadpool(disk_cache.get, file_id) or await load()
+    is_async = getattr(blob, "is_async", False)
+    if memory_cache.enabled and blob.length <= memory_cache.max_item:
+        try:
+            data = await blob.read() if is_async else await run_in_threadpool(blob.read)
+            return memory_cache.put(data, blob_meta(blob))
+        finally:
+            blob.close()
+    if isinstance(blob, FileBlob):
+        return blob
+    return await disk_cache.afill(blob) if is_async else await run_in_threadpool(disk_cache.fill, blob)
+
+
+def discard(file_ids: Iterable[str]):
+    """Evict deleted files from every tier"""
+    file_ids = [str(i) for i in file_ids]
+    memory_cache.discard(file_ids)
+    disk_cache.discard(file_ids)
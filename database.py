@@ -3,11 +3,37 @@ Database Helper Functions
 
 MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
+
+`adb` (Motor) serves request handlers, `db` (PyMongo) background threads
+and command-line tools; `adb_public` is `adb` with the public read
+preference, for public reads (see public_find_one). pool_stats() reports
+pool use for sizing DATABASE_MAX_POOL_SIZE, which applies per process,
+client and server.
+
+Settings (environment):
+    DATABASE_MAX_POOL_SIZE                  connections per client and server (default: 100)
+    DATABASE_MIN_POOL_SIZE                  connections kept open when idle (default: 0)
+    DATABASE_WAIT_QUEUE_TIMEOUT_MS          longest wait for a free connection; 0 waits forever (default: 10000)
+    DATABASE_COMPRESSORS                    wire compressors in order of preference, e.g. zstd,snappy,zlib;
+                                            ones whose library isn't installed are skipped (default: none)
+    DATABASE_READ_PREFERENCE                default read preference (default: primary)
+    DATABASE_SERVER_SELECTION_TIMEOUT_MS    how long an operation waits for a suitable server (default: 5000)
+    DATABASE_CONNECT_TIMEOUT_MS             TCP connect timeout (default: 10000)
+    DATABASE_SOCKET_TIMEOUT_MS              per-operation socket timeout; 0 means none (default: 0)
+    DATABASE_PUBLIC_READ_PREFERENCE         read preference of public reads (default: secondaryPreferred)
+    DATABASE_MAX_STALENESS_SECONDS          skip secondaries lagging more than this; at least 90,
+                                            -1 means no limit (default: 120)
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import MongoClient, monitoring
+from pymongo.errors import PyMongoError
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
 from datetime import datetime, timezone
+import importlib.util
+import logging
 import os
+import threading
 from dotenv import load_dotenv
 from typing import Union
 from pydantic import BaseModel
@@ -15,15 +41,233 @@ from pydantic import BaseModel
 # Load environment variables from .env file
 load_dotenv()
 
-_client = None
-db = None
+logger = logging.getLogger(__name__)
 
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
+DATABASE_MAX_POOL_SIZE = int(os.getenv("DATABASE_MAX_POOL_SIZE", "100"))
+DATABASE_MIN_POOL_SIZE = int(os.getenv("DATABASE_MIN_POOL_SIZE", "0"))
+DATABASE_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("DATABASE_WAIT_QUEUE_TIMEOUT_MS", "10000"))
+DATABASE_COMPRESSORS = os.getenv("DATABASE_COMPRESSORS", "")
+DATABASE_READ_PREFERENCE = os.getenv("DATABASE_READ_PREFERENCE", "primary")
+DATABASE_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("DATABASE_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+DATABASE_CONNECT_TIMEOUT_MS = int(os.getenv("DATABASE_CONNECT_TIMEOUT_MS", "10000"))
+DATABASE_SOCKET_TIMEOUT_MS = int(os.getenv("DATABASE_SOCKET_TIMEOUT_MS", "0"))
+DATABASE_PUBLIC_READ_PREFERENCE = os.getenv("DATABASE_PUBLIC_READ_PREFERENCE", "secondaryPreferred")
+DATABASE_MAX_STALENESS_SECONDS = int(os.getenv("DATABASE_MAX_STALENESS_SECONDS", "120"))
+
+_READ_PREFERENCES = {
+    "primary": Primary, "primaryPreferred": PrimaryPreferred, "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred, "nearest": Nearest,
+}
+# The server's floor for maxStalenessSeconds
+_MIN_MAX_STALENESS = 90
+
+# Python package each optional compressor needs; zlib ships with Python
+_COMPRESSOR_MODULES = {"zstd": "zstandard", "snappy": "snappy", "zlib": "zlib"}
+
+
+def available_compressors(spec: str) -> list:
+    names = [c.strip().lower() for c in spec.split(",") if c.strip()]
+    usable = [c for c in names if c in _COMPRESSOR_MODULES and importlib.util.find_spec(_COMPRESSOR_MODULES[c])]
+    for c in names:
+        if c not in usable:
+            logger.warning("compressor %s is not available, skipping it", c)
+    return usable
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Connection pool counters of one client, across all its servers"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.created = 0
+        self.closed = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_queue_timeouts = 0
+        self.cleared = 0
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.cleared += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+            self.created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+            self.closed += 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+            if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+                self.wait_queue_timeouts += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "open": self.open,
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "created": self.created,
+                "closed": self.closed,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "wait_queue_timeouts": self.wait_queue_timeouts,
+                "cleared": self.cleared,
+            }
+
+
+def client_options() -> dict:
+    """MongoClient keyword arguments from the environment"""
+    options = {
+        "maxPoolSize": DATABASE_MAX_POOL_SIZE,
+        "minPoolSize": DATABASE_MIN_POOL_SIZE,
+        "waitQueueTimeoutMS": DATABASE_WAIT_QUEUE_TIMEOUT_MS or None,
+        "readPreference": DATABASE_READ_PREFERENCE,
+        "serverSelectionTimeoutMS": DATABASE_SERVER_SELECTION_TIMEOUT_MS,
+        "connectTimeoutMS": DATABASE_CONNECT_TIMEOUT_MS,
+        "socketTimeoutMS": DATABASE_SOCKET_TIMEOUT_MS or None,
+        # Stored datetimes are UTC; hand them back timezone-aware so they compare with datetime.now(timezone.utc)
+        "tz_aware": True,
+    }
+    compressors = available_compressors(DATABASE_COMPRESSORS)
+    if compressors:
+        options["compressors"] = ",".join(compressors)
+    return options
+
+
+def create_client(url: str, asynchronous: bool = False, listener: PoolStats = None, **overrides):
+    """A MongoClient (or Motor client) configured from the environment; it connects on first use"""
+    options = {**client_options(), **overrides, "connect": False}
+    if listener is not None:
+        options["event_listeners"] = [listener]
+    return (AsyncIOMotorClient if asynchronous else MongoClient)(url, **options)
+
+
+def public_read_preference():
+    """Read preference of public read endpoints, from the environment"""
+    mode = _READ_PREFERENCES.get(DATABASE_PUBLIC_READ_PREFERENCE)
+    if mode is None:
+        raise ValueError(f"DATABASE_PUBLIC_READ_PREFERENCE must be one of: {', '.join(_READ_PREFERENCES)}")
+    if mode is Primary:
+        return Primary()
+    staleness = DATABASE_MAX_STALENESS_SECONDS
+    if 0 <= staleness < _MIN_MAX_STALENESS:
+        logger.warning("DATABASE_MAX_STALENESS_SECONDS=%s is below the minimum, using %s", staleness, _MIN_MAX_STALENESS)
+        staleness = _MIN_MAX_STALENESS
+    return mode(max_staleness=staleness)
+
+
+sync_pool = PoolStats()
+async_pool = PoolStats()
+
+_client = None
+db = None
+_async_client = None
+adb = None
+adb_public = None
+
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    _client = create_client(database_url, listener=sync_pool)
     db = _client[database_name]
+    _async_client = create_client(database_url, asynchronous=True, listener=async_pool)
+    adb = _async_client[database_name]
+    # Same client and pool, different server selection
+    _public = public_read_preference()
+    adb_public = adb if isinstance(_public, Primary) else adb.with_options(read_preference=_public)
+
+
+async def public_find_one(collection: str, filt: dict, *args, **kwargs):
+    """find_one for public endpoints: from a secondary, retried on the primary when it isn't there (yet).
+
+    Public reads (albums, photo lists, image serving) use `adb_public`,
+    whose DATABASE_PUBLIC_READ_PREFERENCE sends them to secondaries;
+    admin endpoints and anything reading its own writes stay on `adb` and
+    the primary. A secondary may lag by up to DATABASE_MAX_STALENESS_SECONDS,
+    hence the retry: a photo or share link created a moment ago is found
+    before it has replicated. On a standalone server or single-node replica
+    set the public preference falls back to the primary. `adb_public` is
+    looked up on this module at call time, so tests can point it at a
+    stand-in for a lagging secondary.
+    """
+    doc = await adb_public[collection].find_one(filt, *args, **kwargs)
+    if doc is None and adb_public is not adb:
+        doc = await adb[collection].find_one(filt, *args, **kwargs)
+    return doc
+
+
+async def connect():
+    """Open the async client's pool at startup (fills it to minPoolSize); a database that is down is logged, not fatal"""
+    if adb is None:
+        return
+    try:
+        await adb.command("ping")
+    except PyMongoError as e:
+        logger.warning("database not reachable at startup: %s", e)
+
+
+def close():
+    """Close both clients' pools; pymongo reopens a closed client if it is used again"""
+    for client in (_async_client, _client):
+        if client is not None:
+            client.close()
+
+
+def pool_stats() -> dict:
+    options = client_options()
+    return {
+        "max_pool_size": options["maxPoolSize"],
+        "min_pool_size": options["minPoolSize"],
+        "wait_queue_timeout_ms": options["waitQueueTimeoutMS"],
+        "compressors": options.get("compressors"),
+        "read_preference": options["readPreference"],
+        "public_read_preference": adb_public.read_preference.document if adb_public is not None else None,
+        "async": async_pool.stats(),
+        "sync": sync_pool.stats(),
+    }
+
+
+def gridfs_bucket(bucket_name: str = "fs") -> AsyncIOMotorGridFSBucket:
+    """Async GridFS bucket on the Motor handle"""
+    if adb is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    return AsyncIOMotorGridFSBucket(adb, bucket_name=bucket_name)
+
 
 # Helper functions for common database operations
 def create_document(collection_name: str, data: Union[BaseModel, dict]):
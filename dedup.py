@@ -0,0 +1,64 @@
+"""
+Content-Addressed Deduplication
+
+Uploads are hashed (SHA-256) while they stream in. The blob collection
+maps each hash to the stored original and its derivatives, with a count
+of the photos referencing them. Re-uploading bytes that are already stored
+(the same file in another album, a retried batch) drops the fresh copy and
+reuses the existing one, skipping image processing entirely. Files are
+deleted only when the last referencing photo goes.
+
+A blob whose count reached zero can no longer be claimed and is removed
+together with its files.
+
+claim and register run in upload requests (Motor); release and
+forget_files in purges and the orphan sweep (PyMongo).
+"""
+
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from database import adb, db
+from schemas import Blob
+
+
+async def claim(sha256: str) -> Optional[dict]:
+    """Take a reference on already-stored bytes; None if they aren't stored (or are being released)"""
+    return await adb["blob"].find_one_and_update(
+        {"_id": sha256, "refs": {"$gt": 0}},
+        {"$inc": {"refs": 1}},
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def register(sha256: str, file_id: str, storage: str, size: int, derivatives: List[dict]) -> bool:
+    """Record freshly stored bytes with one reference; False if the hash is already registered"""
+    doc = Blob(file_id=file_id, storage=storage, size=size, derivatives=derivatives, refs=1, created_at=datetime.now(timezone.utc)).model_dump()
+    doc["_id"] = sha256
+    try:
+        await adb["blob"].insert_one(doc)
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+def release(photos: Iterable[dict]) -> List[dict]:
+    """Drop the references held by photos; returns the blobs nobody references any more (already unregistered)"""
+    counts = Counter(p["sha256"] for p in photos if p.get("sha256"))
+    if not counts:
+        return []
+    db["blob"].bulk_write([UpdateOne({"_id": sha}, {"$inc": {"refs": -n}}) for sha, n in counts.items()], ordered=False)
+    dead = list(db["blob"].find({"_id": {"$in": list(counts)}, "refs": {"$lte": 0}}))
+    if dead:
+        db["blob"].delete_many({"_id": {"$in": [b["_id"] for b in dead]}, "refs": {"$lte": 0}})
+    return dead
+
+
+def forget_files(file_ids: List[str]):
+    """Unregister blobs whose files were removed behind our back (orphan sweep after TTL deletes)"""
+    if file_ids:
+        db["blob"].delete_many({"$or": [{"file_id": {"$in": file_ids}}, {"derivatives.file_id": {"$in": file_ids}}]})
@@ -0,0 +1,164 @@
+"""
+Expiry Engine
+
+Bulk removal of expired photos. Expired photos are collected in pages;
+with GridFS storage each page costs three round trips no matter how many
+photos it holds: one delete_many on fs.files, one on fs.chunks and one
+bulk_write on photo.
+
+With EXPIRY_MODE=ttl, MongoDB's TTL monitor deletes expired photo and
+sharetoken documents itself (see indexes.py) and the reaper only runs
+sweep_orphans to reclaim stored files no photo points to any more.
+
+Settings (environment):
+    EXPIRY_MODE                 reaper or ttl (default: reaper)
+    ORPHAN_GRACE_SECONDS        minimum age of a file before it may be swept (default: 3600)
+"""
+
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+import blobcache
+import dedup
+import renditions
+from database import db
+from storage import STORES, get_store
+
+EXPIRY_MODE = os.getenv("EXPIRY_MODE", "reaper")
+# Uploads write the file before the photo document; don't sweep files that young
+ORPHAN_GRACE_SECONDS = int(os.getenv("ORPHAN_GRACE_SECONDS", "3600"))
+
+
+def photo_file_ids(photos: Iterable[dict]) -> List[str]:
+    """File ids referenced by photo documents, originals and derivatives"""
+    ids = []
+    for p in photos:
+        ids.append(p.get("file_id"))
+        ids.extend(d.get("file_id") for d in p.get("derivatives") or [])
+    return [i for i in ids if i]
+
+
+def delete_files(file_ids: List[str], storage: Optional[str] = None) -> int:
+    """Delete files from a storage backend in bulk and evict them from the caches"""
+    if not file_ids:
+        return 0
+    removed = get_store(storage).delete_many(file_ids)
+    blobcache.discard(file_ids)
+    return removed
+
+
+async def adelete_files(file_ids: List[str], storage: Optional[str] = None) -> int:
+    """delete_files() for request handlers"""
+    if not file_ids:
+        return 0
+    removed = await get_store(storage).adelete_many(file_ids)
+    await run_in_threadpool(blobcache.discard, file_ids)
+    return removed
+
+
+def delete_grouped(owners: Iterable[dict]) -> int:
+    """Delete the files of photo-like documents (file_id, derivatives, storage) held in any backend"""
+    by_storage: Dict[Optional[str], List[dict]] = defaultdict(list)
+    for owner in owners:
+        by_storage[owner.get("storage")].append(owner)
+    removed = 0
+    for storage, group in by_storage.items():
+        ids = photo_file_ids(group)
+        removed += delete_files(ids, storage)
+        # Renditions of a deleted original go with it
+        delete_grouped(renditions.release_sources(ids))
+    return removed
+
+
+def purge_photos(photos: List[dict]) -> int:
+    """Delete photo documents together with their stored files; returns the number of photos removed"""
+    if not photos:
+        return 0
+    # One by one, so only the call that actually deleted a photo releases its references:
+    # a photo purged twice at once (a DELETE racing the reaper) must not drop a shared blob's count twice
+    deleted = [d for d in (db["photo"].find_one_and_delete({"_id": p["_id"]}) for p in photos) if d is not None]
+    # Shared (deduplicated) bytes go only with their last reference; unshared ones go now
+    unreferenced = dedup.release(deleted) + [p for p in deleted if not p.get("sha256")]
+    delete_grouped(unreferenced)
+    return len(deleted)
+
+
+def cleanup_expired(batch_size: int = 500, time_budget: float = 30.0) -> dict:
+    """Purge expired photos page by page until none are left or the time budget is spent"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    started = time.monotonic()
+    now = datetime.now(timezone.utc)
+    removed = 0
+    batches = 0
+    complete = False
+    while time.monotonic() - started < time_budget:
+        page = list(db["photo"].find({"expires_at": {"$lte": now}}, {"file_id": 1, "derivatives.file_id": 1, "storage": 1, "sha256": 1}).limit(batch_size))
+        if not page:
+            complete = True
+            break
+        removed += purge_photos(page)
+        batches += 1
+    if complete:
+        db["sharetoken"].delete_many({"expires_at": {"$lte": now}})
+    return {
+        "removed": removed,
+        "batches": batches,
+        "complete": complete,
+        "started_at": now.isoformat(),
+        "elapsed_seconds": round(time.monotonic() - started, 3),
+    }
+
+
+def sweep_orphans(batch_size: int = 500, time_budget: float = 30.0, after: Optional[str] = None) -> dict:
+    """Delete stored files no photo or rendition references, walking each backend in id order.
+
+    `after` / the returned `resume_after` ("<backend>:<file id>") let the next
+    run continue where the time budget ran out.
+    """
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    started = time.monotonic()
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(seconds=ORPHAN_GRACE_SECONDS)
+    names = list(STORES)
+    name, _, last_id = (after or f"{names[0]}:").partition(":")
+    position = names.index(name) if name in names else 0
+    last_id = last_id or None
+    removed = 0
+    batches = 0
+    complete = False
+    while time.monotonic() - started < time_budget:
+        page = STORES[names[position]].list_files(after=last_id, limit=batch_size)
+        if not page:
+            # This backend is done; move on to the next one
+            position, last_id = position + 1, None
+            if position == len(names):
+                complete = True
+                break
+            continue
+        last_id = page[-1][0]
+        ids = [file_id for file_id, _ in page]
+        owners = db["photo"].find({"$or": [{"file_id": {"$in": ids}}, {"derivatives.file_id": {"$in": ids}}]}, {"file_id": 1, "derivatives.file_id": 1})
+        referenced = set(photo_file_ids(owners))
+        referenced.update(r["file_id"] for r in db["rendition"].find({"file_id": {"$in": ids}}, {"file_id": 1}))
+        orphans = [file_id for file_id, uploaded in page if file_id not in referenced and uploaded < cutoff]
+        removed += delete_files(orphans, names[position])
+        dedup.forget_files(orphans)
+        delete_grouped(renditions.release_sources(orphans))
+        batches += 1
+    return {
+        "removed": removed,
+        "batches": batches,
+        "complete": complete,
+        "resume_after": None if complete else f"{names[position]}:{last_id or ''}",
+        "started_at": now.isoformat(),
+        "elapsed_seconds": round(time.monotonic() - started, 3),
+    }
@@ -0,0 +1,152 @@
+"""
+Image Processing Engine
+
+Runs CPU-bound image work (images.py) on a process pool so resizing and
+re-encoding never block the event loop and spread across every core.
+
+At most IMAGE_QUEUE_SIZE jobs are handed to the pool at once; further
+callers wait for a slot (backpressure) and are counted as queued. A job that
+exceeds IMAGE_JOB_TIMEOUT_SECONDS fails its caller; the worker finishes it in
+the background and keeps its slot until then, so timeouts never let more
+than IMAGE_QUEUE_SIZE jobs into the pool. A caller can take its slot
+before the job (image_engine.slot()) to fetch the job's input under the
+same bound.
+
+Settings (environment):
+    IMAGE_WORKERS               worker processes (default: CPU count)
+    IMAGE_QUEUE_SIZE            jobs admitted to the pool at once (default: 2 x workers)
+    IMAGE_JOB_TIMEOUT_SECONDS   per-job timeout (default: 120)
+"""
+
+import asyncio
+import multiprocessing
+import os
+import time
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "0")) or os.cpu_count() or 1
+IMAGE_QUEUE_SIZE = int(os.getenv("IMAGE_QUEUE_SIZE", "0")) or 2 * IMAGE_WORKERS
+IMAGE_JOB_TIMEOUT_SECONDS = float(os.getenv("IMAGE_JOB_TIMEOUT_SECONDS", "120"))
+
+
+class Slot:
+    """One admission to the pool; held by its caller until a job is submitted in it, then by the job"""
+
+    def __init__(self, slots: asyncio.Semaphore):
+        self._slots = slots
+        self._held = True
+        self.submitted = False
+
+    def release(self):
+        if self._held:
+            self._held = False
+            self._slots.release()
+
+
+class ImageEngine:
+    """Bounded process pool for image jobs, with queue and timing metrics"""
+
+    def __init__(self, workers: int = IMAGE_WORKERS, queue_size: int = IMAGE_QUEUE_SIZE, job_timeout: float = IMAGE_JOB_TIMEOUT_SECONDS):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.job_timeout = job_timeout
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._slots = asyncio.Semaphore(queue_size)
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def start(self):
+        if self._pool is None:
+            # spawn: forking a process that already runs Mongo client threads is unsafe
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    @asynccontextmanager
+    async def slot(self):
+        """Wait for and hold a slot, e.g. while fetching a job's input; pass it to run to run the job in it"""
+        self.queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queued -= 1
+        slot = Slot(self._slots)
+        try:
+            yield slot
+        finally:
+            if not slot.submitted:
+                slot.release()
+
+    async def run(self, fn: Callable, *args, slot: Optional["Slot"] = None):
+        """Run fn(*args) in a worker process, in slot or once a slot is free, and return its result"""
+        if slot is None:
+            async with self.slot() as slot:
+                return await self.run(fn, *args, slot=slot)
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        self.start()
+        job = self._pool.submit(fn, *args)
+        slot.submitted = True
+        self.in_flight += 1
+        # The slot is freed when the worker is done with the job, not when the caller stops waiting
+        job.add_done_callback(lambda _: self._call_soon(loop, self._job_done, slot))
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(job), self.job_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM on a huge image); replace the pool for later jobs
+            self.failed += 1
+            self.shutdown()
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        else:
+            self.completed += 1
+            return result
+        finally:
+            elapsed = time.monotonic() - started
+            self.total_seconds += elapsed
+            self.max_seconds = max(self.max_seconds, elapsed)
+
+    def _job_done(self, slot: "Slot"):
+        self.in_flight -= 1
+        slot.release()
+
+    @staticmethod
+    def _call_soon(loop: asyncio.AbstractEventLoop, callback: Callable, *args):
+        # Runs on the pool's manager thread; the loop may be gone after shutdown
+        try:
+            loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            pass
+
+    def stats(self) -> dict:
+        finished = self.completed + self.failed + self.timeouts
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "avg_ms": round(1000 * self.total_seconds / finished, 1) if finished else 0.0,
+            "max_ms": round(1000 * self.max_seconds, 1),
+        }
+
+
+image_engine = ImageEngine()
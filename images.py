@@ -0,0 +1,212 @@
+"""
+Image Pipeline
+
+Pillow-based derivatives of uploaded photos. Every upload is resized to
+each configured size and the results are stored next to the original and
+recorded on Photo.derivatives, so galleries can fetch a 320px tile instead
+of a full camera JPEG. Each size is also encoded in every format of
+DERIVATIVE_FORMATS the local Pillow can write (WebP; AVIF with Pillow 11.2+
+or the pillow-avif-plugin package installed), for clients that accept them.
+
+render_edited applies a photo's stored edits (brightness, contrast, crop)
+and, for photos uploaded with watermark=True, composites the watermark
+overlay, for renditions.py. The overlay is an image file (PNG with alpha)
+or, without one, a line of text; it is scaled to a fraction of the
+rendered width.
+
+Settings (environment):
+    PHOTO_DERIVATIVES   comma-separated name:max_edge pairs (default: thumb:320,medium:1024,full:2048)
+    DERIVATIVE_QUALITY  JPEG quality of derivatives (default: 82)
+    DERIVATIVE_FORMATS  extra formats to encode derivatives in, most preferred first (default: avif,webp)
+    WEBP_QUALITY        WebP quality (default: 80)
+    AVIF_QUALITY        AVIF quality (default: 60)
+    WATERMARK_IMAGE     overlay image path (default: none, use WATERMARK_TEXT)
+    WATERMARK_TEXT      overlay text when there is no image (default: flamesblue.com)
+    WATERMARK_OPACITY   overlay opacity, 0-1 (default: 0.4)
+    WATERMARK_SCALE     overlay width as a fraction of the image width (default: 0.3)
+    WATERMARK_POSITION  center, bottom-right or tile (default: bottom-right)
+"""
+
+import functools
+import hashlib
+import io
+import json
+import os
+from typing import Dict, List, Optional, Union
+
+from PIL import Image, ImageDraw, ImageEnhance, ImageFont, ImageOps, UnidentifiedImageError
+
+try:
+    import pillow_avif  # noqa: F401  registers an AVIF encoder with Pillow < 11.2
+except ImportError:
+    pass
+
+
+def _parse_sizes(spec: str) -> Dict[str, int]:
+    sizes = {}
+    for part in spec.split(","):
+        name, _, edge = part.strip().partition(":")
+        if name and edge:
+            sizes[name] = int(edge)
+    return sizes
+
+
+DERIVATIVE_SIZES = _parse_sizes(os.getenv("PHOTO_DERIVATIVES", "thumb:320,medium:1024,full:2048"))
+DERIVATIVE_QUALITY = int(os.getenv("DERIVATIVE_QUALITY", "82"))
+
+FORMAT_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp", "avif": "image/avif"}
+_SAVE_OPTIONS = {
+    "jpeg": {"quality": DERIVATIVE_QUALITY, "optimize": True, "progressive": True},
+    "webp": {"quality": int(os.getenv("WEBP_QUALITY", "80")), "method": 4},
+    "avif": {"quality": int(os.getenv("AVIF_QUALITY", "60")), "speed": 6},
+}
+
+
+def _writable(fmt: str) -> bool:
+    Image.init()
+    return fmt in FORMAT_TYPES and fmt.upper() in Image.SAVE
+
+
+# Formats Pillow can't write here are dropped, so they are never offered
+DERIVATIVE_FORMATS = [f for f in (s.strip().lower() for s in os.getenv("DERIVATIVE_FORMATS", "avif,webp").split(",")) if f != "jpeg" and _writable(f)]
+
+WATERMARK_IMAGE = os.getenv("WATERMARK_IMAGE", "")
+WATERMARK_TEXT = os.getenv("WATERMARK_TEXT", "flamesblue.com")
+WATERMARK_OPACITY = float(os.getenv("WATERMARK_OPACITY", "0.4"))
+WATERMARK_SCALE = float(os.getenv("WATERMARK_SCALE", "0.3"))
+WATERMARK_POSITION = os.getenv("WATERMARK_POSITION", "bottom-right")
+
+
+def render_derivatives(source: Union[bytes, str]) -> List[dict]:
+    """Resize an image (raw bytes or a file path) to every configured size.
+
+    Returns one dict per size with name, data, content_type, width and height;
+    an empty list if the source is not an image Pillow can read.
+    """
+    try:
+        im = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+        # Let the JPEG decoder downscale while decoding; far cheaper than a full decode
+        largest = max(DERIVATIVE_SIZES.values(), default=0)
+        im.draft("RGB", (largest, largest))
+        im = ImageOps.exif_transpose(im)
+    except Exception:
+        return []
+    if im.mode not in ("RGB", "L"):
+        im = im.convert("RGB")
+
+    out = []
+    # Largest first so each smaller size is resampled from an already reduced image
+    for name, edge in sorted(DERIVATIVE_SIZES.items(), key=lambda kv: -kv[1]):
+        im.thumbnail((edge, edge), Image.LANCZOS)
+        for fmt in ["jpeg", *DERIVATIVE_FORMATS]:
+            out.append({"name": name, **_encode(im, fmt)})
+    return out
+
+
+def _encode(im: Image.Image, fmt: str = "jpeg") -> dict:
+    buf = io.BytesIO()
+    im.save(buf, fmt.upper(), **_SAVE_OPTIONS[fmt])
+    return {"data": buf.getvalue(), "content_type": FORMAT_TYPES[fmt], "width": im.width, "height": im.height}
+
+
+def _crop_box(crop: Dict[str, float], width: int, height: int) -> Optional[tuple]:
+    """Pixel box of a crop given as x,y,w,h percentages; None if it selects nothing"""
+    x, y, w, h = (max(0.0, min(100.0, float(crop.get(k, default)))) for k, default in (("x", 0), ("y", 0), ("w", 100), ("h", 100)))
+    box = (round(width * x / 100), round(height * y / 100), round(width * min(100.0, x + w) / 100), round(height * min(100.0, y + h) / 100))
+    return box if box[2] > box[0] and box[3] > box[1] else None
+
+
+@functools.lru_cache(maxsize=8)
+def _file_digest(path: str, mtime: float, size: int) -> str:
+    with open(path, "rb") as fh:
+        return hashlib.sha1(fh.read()).hexdigest()
+
+
+def watermark_spec() -> Optional[dict]:
+    """The current overlay settings, or None if no overlay is configured.
+
+    Includes a digest of the overlay image, so replacing the file changes the
+    spec (and with it every watermarked rendition's key).
+    """
+    spec = {"text": WATERMARK_TEXT, "opacity": WATERMARK_OPACITY, "scale": WATERMARK_SCALE, "position": WATERMARK_POSITION}
+    if WATERMARK_IMAGE:
+        st = os.stat(WATERMARK_IMAGE)
+        spec.update(image=WATERMARK_IMAGE, digest=_file_digest(WATERMARK_IMAGE, st.st_mtime, st.st_size), text=None)
+    elif not WATERMARK_TEXT:
+        return None
+    return spec
+
+
+def watermark_version(spec: dict) -> str:
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:12]
+
+
+@functools.lru_cache(maxsize=4)
+def _overlay(image: Optional[str], digest: Optional[str], text: Optional[str]) -> Image.Image:
+    """The unscaled overlay; cached per worker process (digest changes when the file does)"""
+    if image:
+        with Image.open(image) as im:
+            return im.convert("RGBA")
+    font = ImageFont.load_default(size=64)
+    left, top, right, bottom = font.getbbox(text)
+    pad = 8
+    im = Image.new("RGBA", (right - left + 2 * pad, bottom - top + 2 * pad), (0, 0, 0, 0))
+    ImageDraw.Draw(im).text((pad - left, pad - top), text, font=font, fill=(255, 255, 255, 255), stroke_width=2, stroke_fill=(0, 0, 0, 255))
+    return im
+
+
+def _apply_watermark(im: Image.Image, spec: dict) -> Image.Image:
+    overlay = _overlay(spec.get("image"), spec.get("digest"), spec.get("text"))
+    width = max(1, int(im.width * spec["scale"]))
+    height = max(1, round(overlay.height * width / overlay.width))
+    if height > im.height:
+        width, height = max(1, round(width * im.height / height)), im.height
+    overlay = overlay.resize((width, height), Image.LANCZOS)
+    if spec["opacity"] < 1:
+        overlay.putalpha(overlay.getchannel("A").point(lambda a: int(a * spec["opacity"])))
+    base = im.convert("RGBA")
+    margin = im.width // 50
+    if spec["position"] == "tile":
+        spots = [(x, y) for y in range(0, im.height, height + 4 * margin) for x in range(0, im.width, width + 4 * margin)]
+    elif spec["position"] == "center":
+        spots = [((im.width - width) // 2, (im.height - height) // 2)]
+    else:
+        spots = [(max(0, im.width - width - margin), max(0, im.height - height - margin))]
+    for spot in spots:
+        base.alpha_composite(overlay, spot)
+    return base.convert("RGB")
+
+
+def render_edited(source: Union[bytes, str], edits: dict, edge: Optional[int] = None, watermark: Optional[dict] = None, fmt: str = "jpeg") -> Optional[dict]:
+    """Apply edits (brightness and contrast factors, crop percentages), fit to edge if given, then watermark and encode as fmt.
+
+    Returns data, content_type, width and height, or None if the source is
+    not an image Pillow can read. Failing to read the source (a missing
+    path, an I/O error) raises: the caller must not mistake it for a
+    non-image and serve the stored file instead.
+    """
+    crop = edits.get("crop")
+    try:
+        im = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    except UnidentifiedImageError:
+        return None
+    if edge:
+        # Decode only as large as the cropped region needs to be
+        fraction = min(float(crop.get("w", 100)), float(crop.get("h", 100))) / 100 if crop else 1.0
+        need = int(edge / max(fraction, 0.01))
+        im.draft("RGB", (need, need))
+    im = ImageOps.exif_transpose(im)
+    if im.mode not in ("RGB", "L"):
+        im = im.convert("RGB")
+    box = _crop_box(crop, im.width, im.height) if crop else None
+    if box:
+        im = im.crop(box)
+    if edits.get("brightness", 1.0) != 1.0:
+        im = ImageEnhance.Brightness(im).enhance(edits["brightness"])
+    if edits.get("contrast", 1.0) != 1.0:
+        im = ImageEnhance.Contrast(im).enhance(edits["contrast"])
+    if edge:
+        im.thumbnail((edge, edge), Image.LANCZOS)
+    if watermark:
+        im = _apply_watermark(im, watermark)
+    return _encode(im, fmt)
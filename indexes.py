@@ -0,0 +1,210 @@
+"""
+Index Registry
+
+Declares the indexes every collection in schemas.py needs for the queries
+main.py runs, and creates or verifies them at startup. Collections are
+named after the lowercase model class, as in schemas.py.
+
+    python indexes.py ensure    create missing indexes
+    python indexes.py verify    report missing or mismatched indexes
+    python indexes.py explain   print the plan of each hot query; exits 1 on a COLLSCAN
+
+Settings (environment):
+    INDEX_MODE  what the API does at startup: create, verify or off (default: create)
+
+Switching EXPIRY_MODE turns the expires_at indexes into TTL indexes (or
+back); 'create' drops and rebuilds any index whose options changed.
+"""
+
+import logging
+import os
+import sys
+from datetime import datetime, timezone
+from typing import Dict, List, Type
+
+from bson import ObjectId
+from pydantic import BaseModel
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import ConnectionFailure, PyMongoError
+
+from database import db
+from expiry import EXPIRY_MODE
+from schemas import Adminuser, Album, Blob, Photo, Message, Rendition, Sharetoken
+
+logger = logging.getLogger(__name__)
+
+INDEX_MODE = os.getenv("INDEX_MODE", "create")
+
+# In ttl mode the expires_at indexes double as TTL indexes and MongoDB deletes expired documents
+_EXPIRY_OPTIONS = {"expireAfterSeconds": 0} if EXPIRY_MODE == "ttl" else {}
+
+# Options that make two indexes with the same keys different
+_COMPARED_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression", "weights", "default_language")
+
+INDEXES: Dict[Type[BaseModel], List[IndexModel]] = {
+    Photo: [
+        # list_photos: equality on album, keyset sort, expiry filtered inside the index
+        IndexModel([("album_id", ASCENDING), ("uploaded_at", DESCENDING), ("_id", DESCENDING), ("expires_at", ASCENDING)], name="album_uploaded_at_keyset"),
+        # expiry engine and the metrics "expiring soon" list
+        IndexModel([("expires_at", ASCENDING)], name="expires_at", **_EXPIRY_OPTIONS),
+        # orphan sweeper
+        IndexModel([("file_id", ASCENDING)], name="file_id"),
+        IndexModel([("derivatives.file_id", ASCENDING)], name="derivatives_file_id"),
+    ],
+    Album: [
+        IndexModel([("created_at", DESCENDING)], name="created_at"),
+        # list_albums?q=: ranked search on the event name, then the location
+        IndexModel([("event_name", TEXT), ("location", TEXT)], name="search", weights={"event_name": 3, "location": 1}, default_language="english"),
+    ],
+    Sharetoken: [
+        IndexModel([("token", ASCENDING)], name="token", unique=True),
+        IndexModel([("expires_at", ASCENDING)], name="expires_at", **_EXPIRY_OPTIONS),
+    ],
+    Adminuser: [
+        IndexModel([("email", ASCENDING)], name="email", unique=True),
+    ],
+    Message: [
+        IndexModel([("created_at", DESCENDING)], name="created_at"),
+    ],
+    Blob: [
+        # _id is the content hash; these serve forget_files after an orphan sweep
+        IndexModel([("file_id", ASCENDING)], name="file_id"),
+        IndexModel([("derivatives.file_id", ASCENDING)], name="derivatives_file_id"),
+    ],
+    Rendition: [
+        # dropped with their source file; referenced files are kept by the orphan sweeper
+        IndexModel([("source_file_id", ASCENDING)], name="source_file_id"),
+        IndexModel([("file_id", ASCENDING)], name="file_id"),
+    ],
+}
+
+
+def collection_name(model: Type[BaseModel]) -> str:
+    return model.__name__.lower()
+
+
+# Representative shapes of the queries main.py runs on every request path
+HOT_QUERIES = [
+    {"name": "list_photos", "collection": "photo", "filter": lambda now: {"album_id": str(ObjectId()), "expires_at": {"$gt": now}}, "sort": [("uploaded_at", DESCENDING), ("_id", DESCENDING)], "limit": 101},
+    {"name": "list_photos_page", "collection": "photo", "filter": lambda now: {"album_id": str(ObjectId()), "expires_at": {"$gt": now}, "uploaded_at": {"$lte": now}, "$or": [{"uploaded_at": {"$lt": now}}, {"uploaded_at": now, "_id": {"$lt": ObjectId()}}]}, "sort": [("uploaded_at", DESCENDING), ("_id", DESCENDING)], "limit": 101},
+    {"name": "list_albums", "collection": "album", "filter": lambda now: {}, "sort": [("created_at", DESCENDING)], "limit": 60},
+    {"name": "search_albums", "collection": "album", "filter": lambda now: {"$text": {"$search": "wedding"}}, "sort": [("score", {"$meta": "textScore"}), ("created_at", DESCENDING)], "limit": 60},
+    {"name": "view_share", "collection": "sharetoken", "filter": lambda now: {"token": "0" * 16}, "sort": None, "limit": 1},
+    {"name": "admin_login", "collection": "adminuser", "filter": lambda now: {"email": "admin@example.com"}, "sort": None, "limit": 1},
+    {"name": "admin_inbox", "collection": "message", "filter": lambda now: {}, "sort": [("created_at", DESCENDING)], "limit": None},
+    {"name": "cleanup_expired", "collection": "photo", "filter": lambda now: {"expires_at": {"$lte": now}}, "sort": None, "limit": 500},
+    {"name": "sweep_orphans", "collection": "photo", "filter": lambda now: {"$or": [{"file_id": {"$in": [str(ObjectId())]}}, {"derivatives.file_id": {"$in": [str(ObjectId())]}}]}, "sort": None, "limit": None},
+]
+
+
+def _keys(index: dict) -> list:
+    """Key pattern, comparable between a declared and a listed index.
+
+    The server lists a text index's key as _fts/_ftsx and its fields in
+    weights; both sides are reduced to the text fields, sorted, in place of
+    the first text key.
+    """
+    keys, text_fields = [], None
+    for k, v in index["key"].items():
+        if k == "_ftsx" or (v == TEXT and text_fields is not None):
+            continue
+        if k == "_fts" or v == TEXT:
+            text_fields = sorted(index.get("weights") or [k for k, v in index["key"].items() if v == TEXT])
+            keys.extend((f, TEXT) for f in text_fields)
+            continue
+        keys.append((k, int(v) if isinstance(v, (int, float)) else v))
+    return keys
+
+
+def _differs(existing: dict, wanted: dict) -> bool:
+    if _keys(existing) != _keys(wanted):
+        return True
+    return any(existing.get(opt) != wanted.get(opt) for opt in _COMPARED_OPTIONS)
+
+
+def ensure_indexes(mode: str = INDEX_MODE) -> dict:
+    """Create ('create') or only check ('verify') every registered index; returns a report per collection"""
+    if db is None or mode == "off":
+        return {}
+
+    report = {}
+    for model, wanted_indexes in INDEXES.items():
+        name = collection_name(model)
+        coll = db[name]
+        entry = {"ok": [], "created": [], "missing": [], "mismatched": [], "errors": []}
+        report[name] = entry
+        try:
+            existing = {ix["name"]: ix for ix in coll.list_indexes()}
+        except PyMongoError as e:
+            # Report it and let the API start anyway; when the server is unreachable don't wait on it per collection
+            entry["errors"].append(f"list_indexes: {e}")
+            logger.warning("index %s: %s", name, e)
+            if isinstance(e, ConnectionFailure):
+                break
+            continue
+        for index in wanted_indexes:
+            wanted = index.document
+            current = existing.get(wanted["name"])
+            if current is not None and not _differs(current, wanted):
+                entry["ok"].append(wanted["name"])
+                continue
+            bucket = "missing" if current is None else "mismatched"
+            if mode != "create":
+                entry[bucket].append(wanted["name"])
+                continue
+            try:
+                if current is not None:
+                    coll.drop_index(wanted["name"])
+                coll.create_indexes([index])
+                entry["created"].append(wanted["name"])
+            except PyMongoError as e:
+                entry["errors"].append(f"{wanted['name']}: {e}")
+        for key in ("missing", "mismatched", "errors"):
+            for problem in entry[key]:
+                logger.warning("index %s.%s: %s", name, problem, key)
+    return report
+
+
+def _plan_stages(plan: dict) -> List[str]:
+    """Flatten a winning plan into 'STAGE' / 'IXSCAN(name)' labels, root first"""
+    stages = [f"{plan.get('stage', '?')}({plan['indexName']})" if "indexName" in plan else plan.get("stage", "?")]
+    for child in plan.get("inputStages") or ([plan["inputStage"]] if "inputStage" in plan else []):
+        stages.extend(_plan_stages(child))
+    return stages
+
+
+def explain_hot_queries() -> List[dict]:
+    """Explain every hot query; each result carries its plan stages and whether it scans the collection"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    now = datetime.now(timezone.utc)
+    results = []
+    for q in HOT_QUERIES:
+        cur = db[q["collection"]].find(q["filter"](now))
+        if q["sort"]:
+            cur = cur.sort(q["sort"])
+        if q["limit"]:
+            cur = cur.limit(q["limit"])
+        winning = cur.explain()["queryPlanner"]["winningPlan"]
+        stages = _plan_stages(winning.get("queryPlan", winning))
+        results.append({"name": q["name"], "collection": q["collection"], "stages": stages, "collscan": "COLLSCAN" in stages})
+    return results
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "explain"
+    if command in ("ensure", "verify"):
+        report = ensure_indexes("create" if command == "ensure" else "verify")
+        for coll, entry in report.items():
+            print(coll, {k: v for k, v in entry.items() if v})
+        sys.exit(1 if any(e["missing"] or e["mismatched"] or e["errors"] for e in report.values()) else 0)
+    elif command == "explain":
+        results = explain_hot_queries()
+        for r in results:
+            flag = "COLLSCAN" if r["collscan"] else "ok"
+            print(f"{flag:9} {r['name']:16} {r['collection']:11} {' <- '.join(r['stages'])}")
+        sys.exit(1 if any(r["collscan"] for r in results) else 0)
+    else:
+        print(__doc__)
+        sys.exit(2)
@@ -1,19 +1,59 @@
+import asyncio
+import base64
+import functools
+import hashlib
+import io
+import json
+import mimetypes
 import os
+import re
+import zlib
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, Query
+from fastapi import BackgroundTasks, FastAPI, UploadFile, File, Form, HTTPException, Depends, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, RedirectResponse
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
 from pydantic import BaseModel, EmailStr
 from bson import ObjectId
-from gridfs import GridFS
+from gridfs.errors import NoFile
 from passlib.hash import bcrypt
+from pymongo.errors import BulkWriteError
 
-from database import db
+import database
+import renditions
+from blobcache import disk_cache, memory_cache, open_cached_async
+from database import adb, db, public_find_one
 from schemas import Adminuser, Album, Photo, Message, Sharetoken
-
-app = FastAPI(title="flamesblue.com API")
+from expiry import delete_grouped, purge_photos
+from images import DERIVATIVE_SIZES
+from image_engine import image_engine
+from indexes import ensure_indexes
+from reaper import reaper, REAPER_ENABLED
+from responsecache import album_cache
+from storage import default_store, get_store
+from streaming import blob_response, not_modified, parse_range, preferred_type, range_allowed
+from suggest import SUGGEST_LIMIT, SuggestIndex
+from uploads import UPLOAD_CONCURRENCY, store_upload
+from zipstream import ZipEntry, ZipStream
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await database.connect()
+    ensure_indexes()
+    if REAPER_ENABLED and db is not None:
+        reaper.start()
+    image_engine.start()
+    yield
+    image_engine.shutdown()
+    reaper.stop(timeout=5)
+    database.close()
+
+
+app = FastAPI(title="flamesblue.com API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -48,10 +88,27 @@ def serialize(doc: dict) -> dict:
     return d
 
 
-def fs():
-    if db is None:
+def encode_cursor(doc: dict, field: str) -> str:
+    raw = json.dumps({"v": doc[field].isoformat(), "id": str(doc["_id"])})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return datetime.fromisoformat(raw["v"]), ObjectId(raw["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def open_blob(file_id: str, storage: Optional[str] = None):
+    """Stored file by id, read through the memory and disk caches"""
+    if adb is None:
         raise HTTPException(status_code=500, detail="Database not configured")
-    return GridFS(db)
+    try:
+        return await open_cached_async(file_id, lambda: get_store(storage).aopen(file_id))
+    except (NoFile, FileNotFoundError):
+        raise HTTPException(status_code=404, detail="No image")
 
 
 def album_expiry(album: dict) -> datetime:
@@ -60,6 +117,9 @@ def album_expiry(album: dict) -> datetime:
     return base + timedelta(days=days)
 
 
+suggestions = SuggestIndex(album_expiry)
+
+
 # Auth
 class AdminLogin(BaseModel):
     email: EmailStr
@@ -85,20 +145,21 @@ def require_admin(token: Optional[str] = Query(default=None, alias="token")):
 
 
 @app.post("/api/admin/login", response_model=TokenOut)
-def admin_login(payload: AdminLogin):
-    u = db["adminuser"].find_one({"email": payload.email})
+async def admin_login(payload: AdminLogin):
+    u = await adb["adminuser"].find_one({"email": payload.email})
     if not u:
         # bootstrap default admin if none exist and matches env
         default_email = os.getenv("ADMIN_EMAIL", "admin@flamesblue.com")
         default_pass = os.getenv("ADMIN_PASSWORD", "admin")
         if payload.email == default_email and payload.password == default_pass:
-            pwd_hash = bcrypt.hash(default_pass)
-            db["adminuser"].insert_one({"email": default_email, "password_hash": pwd_hash, "created_at": now_utc(), "updated_at": now_utc()})
+            pwd_hash = await run_in_threadpool(bcrypt.hash, default_pass)
+            await adb["adminuser"].insert_one({"email": default_email, "password_hash": pwd_hash, "created_at": now_utc(), "updated_at": now_utc()})
             token = os.urandom(16).hex()
             ADMIN_TOKENS.add(token)
             return TokenOut(token=token)
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    if not bcrypt.verify(payload.password, u.get("password_hash", "")):
+    # bcrypt is deliberately slow; keep it off the event loop
+    if not await run_in_threadpool(bcrypt.verify, payload.password, u.get("password_hash", "")):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     token = os.urandom(16).hex()
     ADMIN_TOKENS.add(token)
@@ -106,50 +167,78 @@ def admin_login(payload: AdminLogin):
 
 
 @app.post("/api/admin/reset/request")
-def reset_request(payload: ResetRequest):
+async def reset_request(payload: ResetRequest):
     code = os.urandom(3).hex()
-    db["adminuser"].update_one({"email": payload.email}, {"$set": {"reset_code": code, "updated_at": now_utc()}})
+    await adb["adminuser"].update_one({"email": payload.email}, {"$set": {"reset_code": code, "updated_at": now_utc()}})
     # In a production app, email this code. Here we just expose it for testing.
     return {"ok": True, "code": code}
 
 
 @app.post("/api/admin/reset/confirm")
-def reset_confirm(payload: ResetConfirm):
-    u = db["adminuser"].find_one({"email": payload.email})
+async def reset_confirm(payload: ResetConfirm):
+    u = await adb["adminuser"].find_one({"email": payload.email})
     if not u or u.get("reset_code") != payload.code:
         raise HTTPException(status_code=400, detail="Invalid reset")
-    db["adminuser"].update_one({"email": payload.email}, {"$set": {"password_hash": bcrypt.hash(payload.password), "reset_code": None, "updated_at": now_utc()}})
+    password_hash = await run_in_threadpool(bcrypt.hash, payload.password)
+    await adb["adminuser"].update_one({"email": payload.email}, {"$set": {"password_hash": password_hash, "reset_code": None, "updated_at": now_utc()}})
     return {"ok": True}
 
 
 # Public - Home
+def search_terms(q: str) -> str:
+    """q as a $text search of its words, any of which may match; quotes and negation are not passed through"""
+    return " ".join(re.findall(r"\w+", q))
+
+
 @app.get("/api/albums")
-def list_albums(q: Optional[str] = None, location: Optional[str] = None, date: Optional[str] = None, limit: int = 60):
-    cleanup_expired()
-    filt = {}
-    if q:
-        filt["$or"] = [{"event_name": {"$regex": q, "$options": "i"}}, {"location": {"$regex": q, "$options": "i"}}]
-    if location:
-        filt["location"] = {"$regex": location, "$options": "i"}
+async def list_albums(q: Optional[str] = None, location: Optional[str] = None, date: Optional[str] = None, limit: int = 60):
+    terms = search_terms(q or "")
+    day = None
     if date:
         try:
             dt = datetime.fromisoformat(date)
-            start = datetime(dt.year, dt.month, dt.day, tzinfo=timezone.utc)
-            end = start + timedelta(days=1)
-            filt["date"] = {"$gte": start, "$lt": end}
+            day = datetime(dt.year, dt.month, dt.day, tzinfo=timezone.utc)
         except Exception:
             pass
-    albums = list(db["album"].find(filt).sort("created_at", -1).limit(limit))
+    key = (terms, location or "", day, limit)
+    albums = album_cache.get(key)
+    if albums is None:
+        generation = album_cache.generation
+        albums = await query_albums(terms, location, day, limit)
+        upcoming = [a["expires_at"] for a in albums if a["expires_at"] > now_utc()]
+        album_cache.put(key, albums, generation, valid_until=min(upcoming, default=None))
     out = []
     for a in albums:
-        d = serialize(a)
-        exp = album_expiry(a)
-        d["expires_at"] = exp.isoformat()
-        d["seconds_left"] = max(0, int((exp - now_utc()).total_seconds()))
+        # Cached listings stay accurate: the countdown is computed per response
+        d = {**a, "expires_at": a["expires_at"].isoformat()}
+        d["seconds_left"] = max(0, int((a["expires_at"] - now_utc()).total_seconds()))
         out.append(d)
     return {"items": out}
 
 
+async def query_albums(terms: str, location: Optional[str], day: Optional[datetime], limit: int) -> List[dict]:
+    """Serialized albums matching the listing's filters, each with its expires_at as a datetime"""
+    filt = {}
+    if terms:
+        # Served by the album text index (indexes.py), best matches first
+        filt["$text"] = {"$search": terms}
+    if location:
+        filt["location"] = {"$regex": re.escape(location), "$options": "i"}
+    if day:
+        filt["date"] = {"$gte": day, "$lt": day + timedelta(days=1)}
+    if terms:
+        cursor = database.adb_public["album"].find(filt, {"score": {"$meta": "textScore"}}).sort([("score", {"$meta": "textScore"}), ("created_at", -1)])
+    else:
+        cursor = database.adb_public["album"].find(filt).sort("created_at", -1)
+    albums = []
+    for a in await cursor.limit(limit).to_list(None):
+        a.pop("score", None)
+        d = serialize(a)
+        d["expires_at"] = album_expiry(a)
+        albums.append(d)
+    return albums
+
+
 class AlbumCreate(BaseModel):
     event_name: str
     location: Optional[str] = None
@@ -159,16 +248,24 @@ class AlbumCreate(BaseModel):
 
 
 @app.post("/api/albums")
-def create_album(payload: AlbumCreate, _: None = Depends(require_admin)):
+async def create_album(payload: AlbumCreate, _: None = Depends(require_admin)):
     doc = Album(**payload.model_dump()).model_dump()
     doc["created_at"], doc["updated_at"] = now_utc(), now_utc()
-    album_id = db["album"].insert_one(doc).inserted_id
+    album_id = (await adb["album"].insert_one(doc)).inserted_id
+    suggestions.add(doc)
+    album_cache.invalidate()
     return {"id": str(album_id)}
 
 
+@app.get("/api/albums/suggest")
+async def suggest_albums(prefix: str = "", limit: int = SUGGEST_LIMIT):
+    await suggestions.refresh()
+    return {"items": suggestions.suggest(prefix, max(1, min(limit, 50)))}
+
+
 @app.get("/api/albums/{album_id}")
-def get_album(album_id: str):
-    a = db["album"].find_one({"_id": oid(album_id)})
+async def get_album(album_id: str):
+    a = await public_find_one("album", {"_id": oid(album_id)})
     if not a:
         raise HTTPException(status_code=404, detail="Album not found")
     d = serialize(a)
@@ -178,56 +275,218 @@ def get_album(album_id: str):
     return d
 
 
+PHOTO_PAGE_SIZE = int(os.getenv("PHOTO_PAGE_SIZE", "100"))
+PHOTO_PAGE_MAX = int(os.getenv("PHOTO_PAGE_MAX", "500"))
+
+
 @app.get("/api/albums/{album_id}/photos")
-def list_photos(album_id: str):
-    cleanup_expired()
-    cur = db["photo"].find({"album_id": album_id, "expires_at": {"$gt": now_utc()}}).sort("uploaded_at", -1)
+async def list_photos(album_id: str, cursor: Optional[str] = None, limit: int = PHOTO_PAGE_SIZE):
+    limit = max(1, min(limit, PHOTO_PAGE_MAX))
+    filt = {"album_id": album_id, "expires_at": {"$gt": now_utc()}}
+    if cursor:
+        # Keyset on (uploaded_at, _id), both descending: every page is an index seek
+        after, after_id = decode_cursor(cursor)
+        # The range bound lets the planner seek to the cursor even without pushing the $or into the index scan
+        filt["uploaded_at"] = {"$lte": after}
+        filt["$or"] = [{"uploaded_at": {"$lt": after}}, {"uploaded_at": after, "_id": {"$lt": after_id}}]
+    page = await database.adb_public["photo"].find(filt).sort([("uploaded_at", -1), ("_id", -1)]).limit(limit + 1).to_list(None)
+    has_more = len(page) > limit
+    page = page[:limit]
     items = []
-    for p in cur:
+    for p in page:
         d = serialize(p)
+        d["image_version"] = renditions.photo_version(p)
         if p.get("expires_at"):
             d["seconds_left"] = max(0, int((p["expires_at"] - now_utc()).total_seconds()))
         items.append(d)
-    return {"items": items}
+    next_cursor = encode_cursor(page[-1], "uploaded_at") if has_more else None
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def photo_name(p: dict, default: Optional[str] = None) -> str:
+    return os.path.basename((p.get("filename") or "").replace("\\", "/")) or default or str(p["_id"])
+
+
+def album_zip_entries(photos: List[dict], rendered: List[Optional[dict]]) -> Tuple[List[ZipEntry], List[dict]]:
+    """One stored entry per photo (its rendition where it has one), with unique file names in upload order.
+
+    Also returns the photos left out because their stored file is gone or,
+    for a watermarked photo, because it has no rendition.
+    """
+    entries, omitted, seen = [], [], set()
+    for i, (p, r) in enumerate(zip(photos, rendered), 1):
+        if r is None and p.get("watermark"):
+            omitted.append(p)
+            continue
+        src = r or p
+        store = get_store(src.get("storage"))
+        size, content_type = src.get("size"), src.get("content_type")
+        if size is None:
+            # Uploaded before sizes were recorded: read them from the stored file
+            try:
+                blob = store.open(src["file_id"])
+            except (NoFile, FileNotFoundError):
+                omitted.append(p)
+                continue
+            size, content_type = blob.length, blob.content_type
+            blob.close()
+        ext = mimetypes.guess_extension(content_type or "") or ".jpg"
+        name = photo_name(p, f"{p['_id']}{ext}")
+        if r is not None:
+            name = os.path.splitext(name)[0] + ext
+        if name in seen:
+            stem, suffix = os.path.splitext(name)
+            name = f"{stem}-{i}{suffix}"
+        seen.add(name)
+        entries.append(ZipEntry(name=name, size=size, mtime=p.get("uploaded_at") or datetime(1980, 1, 1), open=functools.partial(store.open, src["file_id"]), crc32=src.get("crc32"), key=src["file_id"]))
+    return entries, omitted
+
+
+OMITTED_ENTRY = "_omitted.txt"
+
+
+def omitted_entry(pending: List[dict], missing: List[dict], mtime: datetime) -> ZipEntry:
+    """A text entry listing the photos the archive leaves out, and why"""
+    lines = [f"{photo_name(p)}: still being prepared, download the album again in a few minutes" for p in pending]
+    lines += [f"{photo_name(p)}: not available" for p in missing]
+    data = ("\n".join(lines) + "\n").encode("utf-8")
+    return ZipEntry(name=OMITTED_ENTRY, size=len(data), mtime=mtime, open=functools.partial(io.BytesIO, data), crc32=zlib.crc32(data), key=hashlib.sha1(data).hexdigest())
+
+
+@app.get("/api/albums/{album_id}/download.zip")
+async def download_album(request: Request, background: BackgroundTasks, album_id: str):
+    a = await public_find_one("album", {"_id": oid(album_id)})
+    if not a:
+        raise HTTPException(status_code=404, detail="Album not found")
+    photos = await database.adb_public["photo"].find(
+        {"album_id": album_id, "expires_at": {"$gt": now_utc()}, "file_id": {"$ne": None}},
+        {
+            "file_id": 1, "storage": 1, "filename": 1, "content_type": 1, "size": 1, "crc32": 1, "uploaded_at": 1,
+            "brightness": 1, "contrast": 1, "crop": 1, "watermark": 1,
+        },
+    ).sort([("uploaded_at", 1), ("_id", 1)]).to_list(None)
+    # The archive holds what the gallery shows: edited and watermarked photos as their full-size renditions.
+    # Nothing is rendered here; photos whose rendition isn't ready are left out (never shipped unwatermarked),
+    # listed in the archive and rendered in the background for the next download.
+    found = await renditions.lookup(photos)
+    kept = [(p, r) for p, (needed, r) in zip(photos, found) if not needed or r is not None]
+    pending = [p for p, (needed, r) in zip(photos, found) if needed and r is None]
+    entries, missing = await run_in_threadpool(album_zip_entries, [p for p, _ in kept], [r for _, r in kept])
+    if pending or missing:
+        entries.append(omitted_entry(pending, missing, a.get("created_at") or datetime(1980, 1, 1)))
+    if pending:
+        background.add_task(renditions.prerender, pending, full_size_only=True)
+    archive = ZipStream(entries)
+    filename = re.sub(r"[^A-Za-z0-9._-]+", "-", a.get("event_name") or "").strip("-") or album_id
+    headers = {
+        "ETag": archive.etag(),
+        "Cache-Control": "private, no-cache",
+        "Content-Disposition": f'attachment; filename="{filename}.zip"',
+        "Accept-Ranges": "bytes" if archive.seekable else "none",
+        "X-Omitted-Photos": str(len(pending) + len(missing)),
+    }
+    if not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+    byte_range = None
+    if archive.seekable and "range" in request.headers and range_allowed(request, headers):
+        byte_range = parse_range(request.headers["range"], archive.size)
+    if byte_range is None:
+        headers["Content-Length"] = str(archive.size)
+        return StreamingResponse(iter(archive), media_type="application/zip", headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{archive.size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(archive.iter_range(start, end), status_code=206, media_type="application/zip", headers=headers)
 
 
 @app.post("/api/albums/{album_id}/photos")
-async def upload_photos(album_id: str, files: List[UploadFile] = File(default=None), watermark: bool = Form(default=False), _: None = Depends(require_admin)):
-    a = db["album"].find_one({"_id": oid(album_id)})
+async def upload_photos(album_id: str, background: BackgroundTasks, files: List[UploadFile] = File(default=None), watermark: bool = Form(default=False), _: None = Depends(require_admin)):
+    a = await adb["album"].find_one({"_id": oid(album_id)})
     if not a:
         raise HTTPException(status_code=404, detail="Album not found")
-    fs_ = fs()
+    store = default_store()
     expires_at = album_expiry(a)
-    created = 0
-    if files:
-        for f in files:
-            data = await f.read()
-            file_id = fs_.put(data, filename=f.filename, content_type=f.content_type)
-            doc = Photo(album_id=album_id, file_id=str(file_id), uploaded_at=now_utc(), expires_at=expires_at, watermark=watermark).model_dump()
-            db["photo"].insert_one(doc)
-            created += 1
-    return {"created": created}
+    slots = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async def one(f: UploadFile):
+        async with slots:
+            try:
+                stored = await store_upload(f, store)
+            except Exception as e:
+                return {"filename": f.filename, "id": None, "size": 0, "error": str(e) or type(e).__name__}, None
+        doc = Photo(
+            album_id=album_id, file_id=stored["file_id"], storage=stored["storage"], sha256=stored["sha256"],
+            filename=f.filename, content_type=f.content_type, size=stored["size"], crc32=stored["crc32"],
+            uploaded_at=now_utc(), expires_at=expires_at, watermark=watermark, derivatives=stored["derivatives"],
+        ).model_dump()
+        doc["_id"] = ObjectId()
+        return {"filename": f.filename, "id": str(doc["_id"]), "size": stored["size"], "error": None}, doc
+
+    outcomes = await asyncio.gather(*(one(f) for f in files or []))
+    items = [item for item, _ in outcomes]
+    docs = [doc for _, doc in outcomes if doc is not None]
+    if docs:
+        try:
+            await adb["photo"].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            failed = {docs[err["index"]]["_id"]: err.get("errmsg", "insert failed") for err in e.details.get("writeErrors", [])}
+            for item in items:
+                if item["id"] and ObjectId(item["id"]) in failed:
+                    item["error"], item["id"] = failed[ObjectId(item["id"])], None
+            await run_in_threadpool(purge_photos, [d for d in docs if d["_id"] in failed])
+            docs = [d for d in docs if d["_id"] not in failed]
+    if watermark and docs:
+        # Composite the watermark once, now, rather than on the first public view
+        background.add_task(renditions.prerender, docs)
+    return {"created": sum(1 for item in items if item["id"]), "items": items}
+
+
+async def photo_response(request: Request, p: dict, size: Optional[str] = None, expires_at: Optional[datetime] = None):
+    """The photo's image at size, with its edits applied; cacheable as immutable only under a versioned URL (?v=).
+
+    Sized requests are negotiated: clients that accept WebP/AVIF get that
+    encoding of the derivative.
+    """
+    content_type = preferred_type(request.headers.get("accept", ""), renditions.NEGOTIATED_TYPES) if size else None
+    try:
+        rendition = await renditions.resolve(p, size, content_type)
+    except (NoFile, FileNotFoundError):
+        raise HTTPException(status_code=404, detail="No image")
+    if rendition is not None:
+        file_id, storage = rendition["file_id"], rendition["storage"]
+    elif p.get("watermark"):
+        # Only the rendition carries the watermark; the stored files never go out in its place.
+        # No rendition means the original isn't an image, and that won't change on a retry
+        raise HTTPException(status_code=404, detail="No image")
+    else:
+        # No rendition and no stored derivative in the negotiated type: the original isn't an image, serve it as is
+        file_id = renditions.photo_file_id(p, size, content_type or "image/jpeg") or renditions.photo_file_id(p, size)
+        storage = p.get("storage")
+    if not file_id:
+        raise HTTPException(status_code=404, detail="No image")
+    g = await open_blob(file_id, storage)
+    immutable = request.query_params.get("v") == renditions.photo_version(p)
+    return blob_response(request, g, expires_at=expires_at, immutable=immutable, vary="Accept" if size else None)
 
 
 @app.get("/api/photos/{photo_id}/image")
-def get_photo_image(photo_id: str):
-    p = db["photo"].find_one({"_id": oid(photo_id)})
+async def get_photo_image(request: Request, photo_id: str, size: Optional[str] = None):
+    if size is not None and size not in DERIVATIVE_SIZES:
+        raise HTTPException(status_code=400, detail=f"Unknown size; expected one of: {', '.join(DERIVATIVE_SIZES)}")
+    p = await public_find_one("photo", {"_id": oid(photo_id)})
     if not p:
         raise HTTPException(status_code=404, detail="Photo not found")
     if p.get("expires_at") and p["expires_at"] <= now_utc():
         raise HTTPException(status_code=410, detail="Photo expired")
     if p.get("image_url"):
         return RedirectResponse(p["image_url"])  # external URL
-    if not p.get("file_id"):
-        raise HTTPException(status_code=404, detail="No image")
-    g = fs().get(oid(p["file_id"]))
-    return StreamingResponse(g, media_type=g.content_type or "image/jpeg")
+    return await photo_response(request, p, size, expires_at=p.get("expires_at"))
 
 
 @app.get("/api/photos/{photo_id}/download")
-def download_photo(photo_id: str):
+async def download_photo(request: Request, photo_id: str):
     # free for now; simply stream image
-    return get_photo_image(photo_id)
+    return await get_photo_image(request, photo_id)
 
 
 class PhotoEdit(BaseModel):
@@ -237,26 +496,22 @@ class PhotoEdit(BaseModel):
 
 
 @app.patch("/api/photos/{photo_id}")
-def edit_photo(photo_id: str, payload: PhotoEdit, _: None = Depends(require_admin)):
+async def edit_photo(photo_id: str, payload: PhotoEdit, _: None = Depends(require_admin)):
     updates = {k: v for k, v in payload.model_dump().items() if v is not None}
     if not updates:
         return {"updated": False}
     updates["updated_at"] = now_utc()
-    res = db["photo"].update_one({"_id": oid(photo_id)}, {"$set": updates})
+    res = await adb["photo"].update_one({"_id": oid(photo_id)}, {"$set": updates})
     return {"updated": res.modified_count == 1}
 
 
 @app.delete("/api/photos/{photo_id}")
-def delete_photo(photo_id: str, _: None = Depends(require_admin)):
-    p = db["photo"].find_one({"_id": oid(photo_id)})
+async def delete_photo(photo_id: str, _: None = Depends(require_admin)):
+    p = await adb["photo"].find_one({"_id": oid(photo_id)})
     if not p:
         raise HTTPException(status_code=404, detail="Photo not found")
-    try:
-        if p.get("file_id"):
-            fs().delete(oid(p["file_id"]))
-    except Exception:
-        pass
-    db["photo"].delete_one({"_id": p["_id"]})
+    # The purge path is shared with the reaper thread, which uses the blocking client
+    await run_in_threadpool(purge_photos, [p])
     return {"deleted": True}
 
 
@@ -270,16 +525,16 @@ class ContactIn(BaseModel):
 
 
 @app.post("/api/contact")
-def submit_contact(payload: ContactIn):
+async def submit_contact(payload: ContactIn):
     doc = Message(**payload.model_dump()).model_dump()
     doc["created_at"] = now_utc()
-    db["message"].insert_one(doc)
+    await adb["message"].insert_one(doc)
     return {"ok": True}
 
 
 @app.get("/api/admin/inbox")
-def admin_inbox(_: None = Depends(require_admin)):
-    msgs = [serialize(m) for m in db["message"].find().sort("created_at", -1)]
+async def admin_inbox(_: None = Depends(require_admin)):
+    msgs = [serialize(m) async for m in adb["message"].find().sort("created_at", -1)]
     return {"items": msgs}
 
 
@@ -289,71 +544,82 @@ class ShareIn(BaseModel):
 
 
 @app.post("/api/photos/{photo_id}/share")
-def create_share(photo_id: str, payload: ShareIn):
-    p = db["photo"].find_one({"_id": oid(photo_id)})
+async def create_share(photo_id: str, payload: ShareIn):
+    p = await adb["photo"].find_one({"_id": oid(photo_id)})
     if not p:
         raise HTTPException(status_code=404, detail="Photo not found")
     token = os.urandom(8).hex()
     expires_at = now_utc() + timedelta(hours=payload.hours)
     doc = Sharetoken(photo_id=photo_id, token=token, expires_at=expires_at, created_at=now_utc()).model_dump()
-    db["sharetoken"].insert_one(doc)
+    await adb["sharetoken"].insert_one(doc)
     return {"token": token, "url": f"/share/{token}"}
 
 
 @app.get("/share/{token}")
-def view_share(token: str):
-    s = db["sharetoken"].find_one({"token": token})
+async def view_share(request: Request, token: str):
+    s = await public_find_one("sharetoken", {"token": token})
     if not s:
         raise HTTPException(status_code=404, detail="Invalid link")
     if s["expires_at"] <= now_utc():
         raise HTTPException(status_code=410, detail="Link expired")
-    p = db["photo"].find_one({"_id": oid(s["photo_id"])})
+    p = await public_find_one("photo", {"_id": oid(s["photo_id"])})
     if not p:
         raise HTTPException(status_code=404, detail="Photo not found")
     if p.get("image_url"):
         return RedirectResponse(p["image_url"])  # external URL
-    g = fs().get(oid(p["file_id"]))
-    return StreamingResponse(g, media_type=g.content_type or "image/jpeg")
+    expires_at = min(d for d in (s["expires_at"], p.get("expires_at")) if d is not None)
+    return await photo_response(request, p, expires_at=expires_at)
 
 
 # Dashboard
 @app.get("/api/admin/metrics")
-def metrics(_: None = Depends(require_admin)):
-    total_events = db["album"].count_documents({})
-    total_photos = db["photo"].count_documents({})
-    downloads = db["photo"].aggregate([{ "$group": {"_id": None, "sum": {"$sum": "$downloads"}} }])
-    downloads_sum = next(downloads, {"sum": 0}).get("sum", 0)
-    recent_albums = [serialize(a) for a in db["album"].find().sort("created_at", -1).limit(5)]
+async def metrics(_: None = Depends(require_admin)):
+    total_events = await adb["album"].count_documents({})
+    total_photos = await adb["photo"].count_documents({})
+    downloads = await adb["photo"].aggregate([{ "$group": {"_id": None, "sum": {"$sum": "$downloads"}} }]).to_list(1)
+    downloads_sum = (downloads or [{"sum": 0}])[0].get("sum", 0)
+    recent_albums = [serialize(a) async for a in adb["album"].find().sort("created_at", -1).limit(5)]
     soon = now_utc() + timedelta(days=3)
-    expiring = [serialize(p) for p in db["photo"].find({"expires_at": {"$lte": soon}}).limit(10)]
+    expiring = [serialize(p) async for p in adb["photo"].find({"expires_at": {"$lte": soon}}).limit(10)]
     return {
         "total_events": total_events,
         "total_photos": total_photos,
         "downloads": downloads_sum,
         "recent_albums": recent_albums,
         "expiring_photos": expiring,
+        "image_engine": image_engine.stats(),
+        "database_pool": database.pool_stats(),
+        "renditions": renditions.stats(),
+        "suggestions": suggestions.stats(),
+        "album_cache": album_cache.stats(),
+        "memory_cache": memory_cache.stats(),
+        "disk_cache": disk_cache.stats(),
     }
 
 
-# Expiration + cleanup
+@app.post("/api/admin/albums/{album_id}/watermark")
+async def rewatermark_album(album_id: str, _: None = Depends(require_admin)):
+    """Re-render an album's watermarked photos, e.g. after the overlay changed"""
+    photos = await adb["photo"].find({"album_id": album_id, "watermark": True, "expires_at": {"$gt": now_utc()}}).to_list(None)
+    result = await renditions.prerender(photos)
+    stale = await run_in_threadpool(renditions.release_stale_overlays, photos)
+    await run_in_threadpool(delete_grouped, stale)
+    return {**result, "stale_removed": len(stale)}
+
+
+# Expiration + cleanup (the reaper runs in the background; see reaper.py)
 @app.post("/api/admin/cleanup")
 def run_cleanup(_: None = Depends(require_admin)):
-    return cleanup_expired()
+    try:
+        result = reaper.run_once(force=True)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Cleanup failed: {e}")
+    return {**result, "reaper": reaper.status()}
 
 
-def cleanup_expired():
-    removed = 0
-    now = now_utc()
-    cur = db["photo"].find({"expires_at": {"$lte": now}})
-    for p in cur:
-        try:
-            if p.get("file_id"):
-                fs().delete(oid(p["file_id"]))
-        except Exception:
-            pass
-        db["photo"].delete_one({"_id": p["_id"]})
-        removed += 1
-    return {"removed": removed}
+@app.get("/api/admin/cleanup")
+def cleanup_status(_: None = Depends(require_admin)):
+    return reaper.status()
 
 
 @app.get("/")
@@ -0,0 +1,171 @@
+"""
+Background Expiry Reaper
+
+Runs the expiry engine (expiry.py) on a schedule so public reads never pay
+for expiry work; in EXPIRY_MODE=ttl it sweeps orphaned stored files instead.
+Runs as a daemon thread inside the API's lifespan, or standalone as a
+worker:
+
+    python reaper.py
+
+Every API worker starts a reaper, but only one per deployment reaps: a
+pass first takes the "reaper" lease document in MongoDB, and a worker
+that finds it held by another, unexpired owner skips the pass. The
+holder renews the lease on every pass and gives it up when it stops; if
+it dies, the lease lapses after REAPER_LEASE_SECONDS and another worker
+takes over. Passes started from the admin endpoint don't need the lease.
+
+Settings (environment):
+    REAPER_ENABLED              run inside the API process (default: 1)
+    REAPER_INTERVAL_SECONDS     pause between runs (default: 300)
+    REAPER_BATCH_SIZE           photos fetched per batch (default: 500)
+    REAPER_TIME_BUDGET_SECONDS  max wall time of a single run (default: 30)
+    REAPER_LEASE_SECONDS        how long a reaper that stopped renewing keeps the lease (default: interval + 2 x budget)
+"""
+
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from database import db
+from expiry import EXPIRY_MODE, cleanup_expired, sweep_orphans
+
+REAPER_ENABLED = os.getenv("REAPER_ENABLED", "1") != "0"
+REAPER_INTERVAL_SECONDS = float(os.getenv("REAPER_INTERVAL_SECONDS", "300"))
+REAPER_BATCH_SIZE = int(os.getenv("REAPER_BATCH_SIZE", "500"))
+REAPER_TIME_BUDGET_SECONDS = float(os.getenv("REAPER_TIME_BUDGET_SECONDS", "30"))
+REAPER_LEASE_SECONDS = float(os.getenv("REAPER_LEASE_SECONDS", str(REAPER_INTERVAL_SECONDS + 2 * REAPER_TIME_BUDGET_SECONDS)))
+
+_LEASE_ID = "reaper"
+
+
+class Reaper:
+    """Runs the expiry engine periodically on a daemon thread and keeps stats of what it did"""
+
+    def __init__(self, interval: float = REAPER_INTERVAL_SECONDS, batch_size: int = REAPER_BATCH_SIZE, time_budget: float = REAPER_TIME_BUDGET_SECONDS, mode: str = EXPIRY_MODE, lease: float = REAPER_LEASE_SECONDS):
+        self.mode = mode
+        self.interval = interval
+        self.batch_size = batch_size
+        self.time_budget = time_budget
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.holds_lease = False
+        self.runs = 0
+        self.skipped = 0
+        self.total_removed = 0
+        self.last_run: Optional[dict] = None
+        self.last_error: Optional[str] = None
+        self._sweep_after: Optional[str] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _acquire(self) -> bool:
+        """Take or renew the lease; False while another reaper holds it"""
+        if db is None:
+            # Nothing to coordinate through; the pass reports the missing database
+            return True
+        now = datetime.now(timezone.utc)
+        try:
+            db["lease"].find_one_and_update(
+                {"_id": _LEASE_ID, "$or": [{"owner": self.owner}, {"expires_at": {"$lte": now}}]},
+                {"$set": {"owner": self.owner, "expires_at": now + timedelta(seconds=self.lease)}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # The lease exists and the filter didn't match it: held by another owner
+            self.holds_lease = False
+        else:
+            self.holds_lease = True
+        return self.holds_lease
+
+    def release(self):
+        """Give up the lease so another reaper can take over right away"""
+        if db is not None and self.holds_lease:
+            db["lease"].delete_one({"_id": _LEASE_ID, "owner": self.owner})
+        self.holds_lease = False
+
+    def run_once(self, force: bool = False) -> dict:
+        """Run a single reaping pass; concurrent callers wait for the pass in progress.
+        Without force the pass is skipped while another reaper holds the lease."""
+        with self._lock:
+            if not force and not self._acquire():
+                self.skipped += 1
+                return {"removed": 0, "complete": True, "skipped": True}
+            try:
+                if self.mode == "ttl":
+                    result = sweep_orphans(self.batch_size, self.time_budget, after=self._sweep_after)
+                    self._sweep_after = result["resume_after"]
+                else:
+                    result = cleanup_expired(self.batch_size, self.time_budget)
+            except Exception as e:
+                self.last_error = str(e)
+                raise
+            self.runs += 1
+            self.total_removed += result["removed"]
+            self.last_run = result
+            self.last_error = None
+            return result
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                result = self.run_once()
+            except Exception:
+                result = None
+            # An incomplete run means the backlog outlived the budget; keep going right away
+            if result and not result["complete"]:
+                continue
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="expiry-reaper", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        self.release()
+
+    def status(self) -> dict:
+        return {
+            "running": bool(self._thread and self._thread.is_alive()),
+            "mode": self.mode,
+            "interval_seconds": self.interval,
+            "batch_size": self.batch_size,
+            "time_budget_seconds": self.time_budget,
+            "owner": self.owner,
+            "holds_lease": self.holds_lease,
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "total_removed": self.total_removed,
+            "last_run": self.last_run,
+            "last_error": self.last_error,
+        }
+
+
+reaper = Reaper()
+
+
+if __name__ == "__main__":
+    print(f"Expiry reaper ({reaper.mode}) running every {reaper.interval}s (batch {reaper.batch_size}, budget {reaper.time_budget}s)")
+    while True:
+        try:
+            result = reaper.run_once()
+            print(result, flush=True)
+        except Exception as e:
+            result = None
+            print(f"reaper run failed: {e}", flush=True)
+        if not result or result["complete"]:
+            time.sleep(reaper.interval)
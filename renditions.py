@@ -0,0 +1,272 @@
+"""
+Photo Renditions
+
+Edits made with edit_photo (brightness, contrast, crop) are kept as
+parameters on the photo; the stored original is never changed, and
+neither is the original of a photo uploaded with watermark=True. A
+rendition is the original with the edits and watermark applied, at full
+size or fitted to one of the derivative sizes. Public image routes serve
+renditions, so a watermark is composited once, never per request.
+
+Photos stored before derivatives came in WebP/AVIF get those formats as
+renditions too.
+
+Renditions are rendered lazily on the first request that needs them, in
+the image engine, and stored like any other file under a key hashing the
+source file id and the rendering parameters.
+Later views are served from storage and the blob caches; changing the edits
+changes the key, so the next view renders afresh. Concurrent requests for
+the same missing rendition share one render.
+
+Renders fetch their source in an image engine slot, so the engine bounds
+reads of originals as well as rendering; concurrent renders of one source
+share a single fetch. Watermarked renditions are prerendered in the
+background after upload, a bounded number at a time.
+When the overlay changes (images.watermark_spec), every watermarked
+rendition's key changes with it; prerender re-renders an album in
+parallel, and release_stale_overlays drops what the old overlay made.
+
+Renditions go with their source file (see expiry.py).
+"""
+
+import asyncio
+import hashlib
+import json
+import zlib
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from pymongo.errors import DuplicateKeyError
+
+from blobcache import open_cached_async
+from database import adb, db
+from image_engine import image_engine
+from images import DERIVATIVE_FORMATS, DERIVATIVE_SIZES, FORMAT_TYPES, render_edited, watermark_spec, watermark_version
+from schemas import Rendition
+from storage import default_store, get_store
+
+EDIT_DEFAULTS = {"brightness": 1.0, "contrast": 1.0, "crop": None}
+# Negotiable derivative types, most preferred first
+NEGOTIATED_TYPES = [FORMAT_TYPES[f] for f in DERIVATIVE_FORMATS]
+_TYPE_FORMATS = {t: f for f, t in FORMAT_TYPES.items()}
+
+_inflight: Dict[str, asyncio.Future] = {}
+_sources: Dict[str, list] = {}  # source file id -> [fetch, renders using it]
+rendered = 0
+hits = 0
+
+
+def photo_edits(p: dict) -> dict:
+    """The photo's edits that differ from the defaults"""
+    return {k: p[k] for k, default in EDIT_DEFAULTS.items() if p.get(k, default) != default}
+
+
+def photo_watermark(p: dict) -> Optional[dict]:
+    """The overlay spec the photo is rendered with; None if it isn't watermarked"""
+    return watermark_spec() if p.get("watermark") else None
+
+
+def photo_version(p: dict) -> str:
+    """Changes whenever the photo's served bytes do; image URLs carrying it as ?v= can be cached as immutable"""
+    parts = photo_edits(p)
+    watermark = photo_watermark(p)
+    if watermark:
+        parts["watermark"] = watermark
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def rendition_key(file_id: str, spec: dict) -> str:
+    return hashlib.sha1(json.dumps([file_id, spec], sort_keys=True).encode()).hexdigest()
+
+
+def _derivative_id(p: dict, size: str, content_type: str) -> Optional[str]:
+    for d in p.get("derivatives") or []:
+        if d.get("name") == size and d.get("content_type", "image/jpeg") == content_type:
+            return d["file_id"]
+    return None
+
+
+def photo_file_id(p: dict, size: Optional[str] = None, content_type: str = "image/jpeg") -> Optional[str]:
+    """File id of the stored derivative at size in content_type, falling back to the original when size is None or unknown"""
+    if size:
+        file_id = _derivative_id(p, size, content_type)
+        if file_id or content_type != "image/jpeg":
+            return file_id
+    return p.get("file_id")
+
+
+def _render_spec(p: dict, size: Optional[str], content_type: Optional[str]) -> Optional[dict]:
+    edits, watermark = photo_edits(p), photo_watermark(p)
+    fmt = _TYPE_FORMATS.get(content_type, "jpeg")
+    if size in DERIVATIVE_SIZES:
+        # Not even a JPEG derivative stored (e.g. a failed upload-time resize): the original must not stand in for it
+        missing = _derivative_id(p, size, FORMAT_TYPES[fmt]) is None
+    else:
+        missing = fmt != "jpeg" and photo_file_id(p, size, content_type) is None
+    if not (edits or watermark or missing) or not p.get("file_id"):
+        return None
+    spec = {"size": size, "edits": edits}
+    if watermark:
+        spec["watermark"] = watermark
+    if fmt != "jpeg":
+        spec["format"] = fmt
+    return spec
+
+
+async def _read_source(file_id: str, storage: Optional[str], cached: bool = True):
+    """A path the worker can open, or the bytes when the file isn't on local disk"""
+    load = lambda: get_store(storage).aopen(file_id)
+    blob = await (open_cached_async(file_id, load) if cached else load())
+    try:
+        if getattr(blob, "path", None):
+            return blob.path
+        return await blob.read() if getattr(blob, "is_async", False) else blob.read()
+    finally:
+        blob.close()
+
+
+@asynccontextmanager
+async def _shared_source(file_id: str, storage: Optional[str]):
+    """The source file, fetched once for all renders of it in progress"""
+    entry = _sources.get(file_id)
+    if entry is None:
+        entry = _sources[file_id] = [asyncio.ensure_future(_read_source(file_id, storage)), 0]
+    entry[1] += 1
+    try:
+        yield await asyncio.shield(entry[0])
+    finally:
+        entry[1] -= 1
+        if not entry[1] and _sources.get(file_id) is entry:
+            del _sources[file_id]
+
+
+async def _render(key: str, p: dict, spec: dict) -> Optional[dict]:
+    global rendered
+    args = (spec["edits"], DERIVATIVE_SIZES.get(spec["size"]), spec.get("watermark"), spec.get("format", "jpeg"))
+    # The source is fetched in the engine slot, so the engine's bound covers reads of originals too
+    async with image_engine.slot() as slot, _shared_source(p["file_id"], p.get("storage")) as source:
+        try:
+            out = await image_engine.run(render_edited, source, *args, slot=slot)
+        except FileNotFoundError:
+            if not isinstance(source, str):
+                raise
+            # Evicted from the disk cache before the worker opened it: read from storage instead
+            source = await _read_source(p["file_id"], p.get("storage"), cached=False)
+            out = await image_engine.run(render_edited, source, *args)
+    if out is None:
+        # The source isn't an image: record that, so it isn't fetched and decoded again on every request
+        doc = Rendition(source_file_id=p["file_id"], file_id=None, storage=None, created_at=datetime.now(timezone.utc)).model_dump()
+        doc["_id"] = key
+        try:
+            await adb["rendition"].insert_one(doc)
+        except DuplicateKeyError:
+            pass
+        return None
+    store = default_store()
+    data = out.pop("data")
+    file_id = await store.aput(data, filename=f"rendition/{key}", content_type=out["content_type"])
+    doc = Rendition(
+        source_file_id=p["file_id"], file_id=file_id, storage=store.name, size=len(data), crc32=zlib.crc32(data),
+        overlay=watermark_version(spec["watermark"]) if spec.get("watermark") else None, created_at=datetime.now(timezone.utc), **out,
+    ).model_dump()
+    doc["_id"] = key
+    try:
+        await adb["rendition"].insert_one(doc)
+    except DuplicateKeyError:
+        # Another worker rendered it first
+        await store.adelete_many([file_id])
+        doc = await adb["rendition"].find_one({"_id": key})
+        return doc if doc and doc["file_id"] else None
+    rendered += 1
+    return doc
+
+
+async def resolve(p: dict, size: Optional[str] = None, content_type: Optional[str] = None) -> Optional[dict]:
+    """Rendition of photo p at size (None: full size) in content_type (default JPEG), rendering it if needed.
+
+    None when the stored original or derivative can be served as is: no
+    edits, no watermark and the format is stored (or the original isn't an
+    image, which callers must not serve for a watermarked photo). Failing
+    to read the original raises.
+    """
+    global hits
+    spec = _render_spec(p, size, content_type)
+    if spec is None:
+        return None
+    key = rendition_key(p["file_id"], spec)
+    doc = await adb["rendition"].find_one({"_id": key})
+    if doc is not None:
+        hits += 1
+        return doc if doc["file_id"] else None
+    task = _inflight.get(key)
+    if task is None:
+        task = _inflight[key] = asyncio.ensure_future(_render(key, p, spec))
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # A client going away must not cancel a render other requests wait for
+    return await asyncio.shield(task)
+
+
+async def lookup(photos: List[dict]) -> List[Tuple[bool, Optional[dict]]]:
+    """For each photo: whether it is served through a full-size rendition, and that rendition if it has been rendered; never renders.
+
+    A photo whose original turned out not to be an image is served as is,
+    like resolve does.
+    """
+    specs = [_render_spec(p, None, None) for p in photos]
+    keys = [rendition_key(p["file_id"], spec) if spec else None for p, spec in zip(photos, specs)]
+    wanted = [k for k in keys if k]
+    found = {r["_id"]: r async for r in adb["rendition"].find({"_id": {"$in": wanted}})} if wanted else {}
+    out = []
+    for key in keys:
+        doc = found.get(key)
+        out.append((False, None) if doc is not None and not doc["file_id"] else (key is not None, doc))
+    return out
+
+
+async def prerender(photos: List[dict], concurrency: Optional[int] = None, full_size_only: bool = False) -> dict:
+    """Render every size and format of each photo's renditions, a photo's variants together, concurrency renders at a time"""
+    variants = [(None, None)]
+    if not full_size_only:
+        variants += [(size, t) for size in DERIVATIVE_SIZES for t in [None, *NEGOTIATED_TYPES]]
+    jobs = iter([(p, size, content_type) for p in photos for size, content_type in variants])
+    done = failed = 0
+
+    async def worker():
+        nonlocal done, failed
+        for p, size, content_type in jobs:
+            try:
+                await resolve(p, size, content_type)
+                done += 1
+            except Exception:
+                failed += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency or image_engine.queue_size)))
+    return {"photos": len(photos), "rendered": done, "failed": failed}
+
+
+def release_stale_overlays(photos: List[dict]) -> List[dict]:
+    """Unregister the photos' renditions made with another overlay than the current one; returns them so their files can be deleted"""
+    watermark = watermark_spec()
+    sources = list({p["file_id"] for p in photos if p.get("file_id")})
+    if watermark is None or not sources:
+        return []
+    filt = {"source_file_id": {"$in": sources}, "overlay": {"$nin": [None, watermark_version(watermark)]}}
+    dead = list(db["rendition"].find(filt, {"file_id": 1, "storage": 1}))
+    if dead:
+        db["rendition"].delete_many({"_id": {"$in": [r["_id"] for r in dead]}})
+    return dead
+
+
+def release_sources(file_ids: List[str]) -> List[dict]:
+    """Unregister the renditions of deleted source files; returns them so their files can be deleted"""
+    if not file_ids:
+        return []
+    dead = list(db["rendition"].find({"source_file_id": {"$in": file_ids}}, {"file_id": 1, "storage": 1}))
+    if dead:
+        db["rendition"].delete_many({"_id": {"$in": [r["_id"] for r in dead]}})
+    return dead
+
+
+def stats() -> dict:
+    return {"rendered": rendered, "hits": hits, "in_flight": len(_inflight)}
@@ -0,0 +1,95 @@
+"""
+Response Cache
+
+Keeps recent results of a read endpoint in process memory, keyed by its
+normalized query parameters, so repeated identical requests skip MongoDB.
+Entries are bounded in number with least-recently-used eviction.
+
+An entry is dropped when:
+    - the endpoint's data is written (the writer calls invalidate),
+    - something it lists expires (its valid_until passes),
+    - it is older than the TTL. Other API workers' writes are only seen
+      through this, so it bounds how stale a listing can be.
+
+A query that started before an invalidation doesn't store its result.
+Callers keep time-dependent fields (e.g. seconds_left) out of the cached
+value and compute them when serving.
+
+Settings (environment):
+    ALBUM_CACHE_TTL_SECONDS  longest time an album listing is served from cache; 0 disables it (default: 30)
+    ALBUM_CACHE_MAX_ENTRIES  distinct listings kept (default: 256)
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Hashable, Optional
+
+ALBUM_CACHE_TTL_SECONDS = float(os.getenv("ALBUM_CACHE_TTL_SECONDS", "30"))
+ALBUM_CACHE_MAX_ENTRIES = int(os.getenv("ALBUM_CACHE_MAX_ENTRIES", "256"))
+
+
+class ResponseCache:
+    """Entry-bounded LRU of endpoint results with TTL, expiry and write invalidation"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at, valid_until = entry
+                if time.monotonic() - stored_at < self.ttl and (valid_until is None or datetime.now(timezone.utc) < valid_until):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: Any, generation: int, valid_until: Optional[datetime] = None):
+        """Store value computed since generation; dropped if the data was written to in the meantime"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (value, time.monotonic(), valid_until)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self.generation += 1
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+album_cache = ResponseCache(ALBUM_CACHE_TTL_SECONDS, ALBUM_CACHE_MAX_ENTRIES)
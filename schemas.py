@@ -6,7 +6,7 @@ class name as the collection name.
 """
 from __future__ import annotations
 from pydantic import BaseModel, Field, EmailStr
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from datetime import datetime
 
 class Adminuser(BaseModel):
@@ -30,6 +30,12 @@ class Album(BaseModel):
 class Photo(BaseModel):
     album_id: str
     file_id: Optional[str] = None
+    storage: str = "gridfs"  # blob backend holding file_id and derivatives, see storage.py
+    sha256: Optional[str] = None  # content hash; _id of the shared Blob, see dedup.py
+    filename: Optional[str] = None
+    content_type: Optional[str] = None
+    size: Optional[int] = None
+    crc32: Optional[int] = None  # of the original; lets album ZIPs be laid out up front, see zipstream.py
     image_url: Optional[str] = None
     uploaded_at: Optional[datetime] = None
     expires_at: Optional[datetime] = None
@@ -38,6 +44,7 @@ class Photo(BaseModel):
     crop: Optional[Dict[str, float]] = None  # x,y,w,h percentages
     downloads: int = 0
     watermark: bool = False
+    derivatives: List[Dict[str, Any]] = Field(default_factory=list)  # name, file_id, content_type, width, height
 
 class Message(BaseModel):
     name: str
@@ -52,3 +59,30 @@ class Sharetoken(BaseModel):
     token: str
     expires_at: datetime
     created_at: Optional[datetime] = None
+
+class Blob(BaseModel):
+    # _id is the SHA-256 of the original bytes
+    file_id: str
+    storage: str = "gridfs"
+    size: int = 0
+    derivatives: List[Dict[str, Any]] = Field(default_factory=list)
+    refs: int = 1
+    created_at: Optional[datetime] = None
+
+class Rendition(BaseModel):
+    # _id hashes source_file_id and the rendering parameters, see renditions.py
+    source_file_id: str
+    file_id: Optional[str] = None  # None: the source isn't an image, nothing was rendered
+    storage: Optional[str] = "gridfs"
+    content_type: str = "image/jpeg"
+    size: int = 0
+    crc32: Optional[int] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    overlay: Optional[str] = None  # watermark version it was rendered with, see images.watermark_version
+    created_at: Optional[datetime] = None
+
+class Lease(BaseModel):
+    # _id names the job; only the owner runs it until expires_at, see reaper.py
+    owner: str
+    expires_at: datetime
@@ -0,0 +1,414 @@
+"""
+Blob Storage
+
+Photo bytes (originals and derivatives) live behind a small BlobStore
+interface so they don't have to share the Mongo primary with metadata
+queries. Two backends ship:
+
+    gridfs  files in MongoDB GridFS (the original layout)
+    local   a sharded directory tree on the local filesystem; blobs carry
+            a path and are served with FileResponse (sendfile)
+
+Photo.storage names the backend holding a photo's files; a file keeps its
+id when it moves between backends, so caches and ETags stay valid.
+
+Request handlers use the async methods (aopen, anew_writer, aput,
+adelete_many). GridFS implements them on Motor's GridFS bucket; other
+backends run their blocking methods in the threadpool.
+
+    python storage.py migrate <from> <to> [batch_size]
+
+moves every photo's files from one backend to the other in batches.
+
+Settings (environment):
+    BLOB_BACKEND    backend for new uploads: gridfs or local (default: gridfs)
+    BLOB_LOCAL_DIR  root directory of the local backend (default: ./blobs)
+"""
+
+import json
+import logging
+import os
+import sys
+import tempfile
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+from fastapi.concurrency import run_in_threadpool
+from gridfs import GridFS
+from motor.motor_asyncio import AsyncIOMotorGridIn
+
+from database import adb, db, gridfs_bucket
+
+logger = logging.getLogger(__name__)
+
+BLOB_BACKEND = os.getenv("BLOB_BACKEND", "gridfs")
+BLOB_LOCAL_DIR = os.getenv("BLOB_LOCAL_DIR", os.path.join(os.getcwd(), "blobs"))
+
+_COPY_CHUNK = 1024 * 1024
+
+
+class FileBlob:
+    """A file on local disk with the attributes of a GridOut that responses use"""
+
+    def __init__(self, path: str, meta: dict):
+        self.path = path
+        self._id = meta["file_id"]
+        self.length = meta["length"]
+        self.content_type = meta.get("content_type")
+        self.md5 = meta.get("md5")
+        self.upload_date = datetime.fromisoformat(meta["upload_date"]) if meta.get("upload_date") else None
+        self._fh = None
+
+    def _file(self):
+        if self._fh is None:
+            self._fh = open(self.path, "rb")
+        return self._fh
+
+    def seek(self, pos: int):
+        self._file().seek(pos)
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file().read(size)
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+class AsyncBlob:
+    """A Motor GridOut with the attributes responses use; read() is awaitable"""
+
+    is_async = True
+
+    def __init__(self, grid_out):
+        self._grid_out = grid_out
+        self._id = grid_out._id
+        self.length = grid_out.length
+        self.content_type = grid_out.content_type
+        self.md5 = None
+        self.upload_date = grid_out.upload_date
+        self.filename = grid_out.filename
+
+    async def read(self, size: int = -1) -> bytes:
+        return await self._grid_out.read(size)
+
+    def seek(self, pos: int):
+        self._grid_out.seek(pos)
+
+    def close(self):
+        self._grid_out.close()
+
+
+class _ThreadedWriter:
+    """Async face of a blocking writer"""
+
+    def __init__(self, writer):
+        self._writer = writer
+        self._id = writer._id
+
+    async def write(self, data: bytes):
+        await run_in_threadpool(self._writer.write, data)
+
+    async def close(self):
+        await run_in_threadpool(self._writer.close)
+
+    async def abort(self):
+        await run_in_threadpool(self._writer.abort)
+
+
+class BlobStore:
+    """Interface of a photo byte store; ids are ObjectId strings"""
+
+    name = ""
+
+    def new_writer(self, filename: Optional[str] = None, content_type: Optional[str] = None, file_id: Optional[str] = None):
+        """Writer with write(bytes), close(), abort() and _id"""
+        raise NotImplementedError
+
+    def put(self, data: bytes, filename: Optional[str] = None, content_type: Optional[str] = None, file_id: Optional[str] = None) -> str:
+        writer = self.new_writer(filename=filename, content_type=content_type, file_id=file_id)
+        try:
+            writer.write(data)
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+        return str(writer._id)
+
+    def open(self, file_id: str):
+        """GridOut-like blob: length, content_type, upload_date, md5, _id, seek(), read(), close()"""
+        raise NotImplementedError
+
+    def delete_many(self, file_ids: Iterable[str]) -> int:
+        raise NotImplementedError
+
+    def list_files(self, after: Optional[str] = None, limit: int = 500) -> List[Tuple[str, datetime]]:
+        """(file_id, upload_date) pairs in a fixed backend-defined order, starting after `after`"""
+        raise NotImplementedError
+
+    async def anew_writer(self, filename: Optional[str] = None, content_type: Optional[str] = None, file_id: Optional[str] = None):
+        """Writer with awaitable write(bytes), close() and abort(), and _id"""
+        return _ThreadedWriter(await run_in_threadpool(self.new_writer, filename=filename, content_type=content_type, file_id=file_id))
+
+    async def aput(self, data: bytes, filename: Optional[str] = None, content_type: Optional[str] = None, file_id: Optional[str] = None) -> str:
+        writer = await self.anew_writer(filename=filename, content_type=content_type, file_id=file_id)
+        try:
+            await writer.write(data)
+            await writer.close()
+        except BaseException:
+            await writer.abort()
+            raise
+        return str(writer._id)
+
+    async def aopen(self, file_id: str):
+        """Like open(); the blob's read() may be awaitable (AsyncBlob)"""
+        return await run_in_threadpool(self.open, file_id)
+
+    async def adelete_many(self, file_ids: Iterable[str]) -> int:
+        return await run_in_threadpool(self.delete_many, list(file_ids))
+
+
+class GridFSStore(BlobStore):
+    name = "gridfs"
+    bucket = "fs"
+
+    def _fs(self) -> GridFS:
+        if db is None:
+            raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+        return GridFS(db, collection=self.bucket)
+
+    def new_writer(self, filename=None, content_type=None, file_id=None):
+        kwargs = {"_id": ObjectId(file_id)} if file_id else {}
+        return self._fs().new_file(filename=filename, content_type=content_type, **kwargs)
+
+    def open(self, file_id: str):
+        return self._fs().get(ObjectId(file_id))
+
+    def delete_many(self, file_ids: Iterable[str]) -> int:
+        ids = [ObjectId(i) for i in file_ids if ObjectId.is_valid(i)]
+        if not ids:
+            return 0
+        # Same order as GridFS.delete: hide the file first, then drop its chunks
+        res = db[f"{self.bucket}.files"].delete_many({"_id": {"$in": ids}})
+        db[f"{self.bucket}.chunks"].delete_many({"files_id": {"$in": ids}})
+        return res.deleted_count
+
+    async def anew_writer(self, filename=None, content_type=None, file_id=None):
+        # GridIn rather than the bucket's upload stream: it records contentType like GridFS.new_file does
+        if adb is None:
+            raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+        return AsyncIOMotorGridIn(adb[self.bucket], filename=filename, content_type=content_type, _id=ObjectId(file_id) if file_id else ObjectId())
+
+    async def aopen(self, file_id: str) -> AsyncBlob:
+        return AsyncBlob(await gridfs_bucket(self.bucket).open_download_stream(ObjectId(file_id)))
+
+    async def adelete_many(self, file_ids: Iterable[str]) -> int:
+        ids = [ObjectId(i) for i in file_ids if ObjectId.is_valid(i)]
+        if not ids:
+            return 0
+        res = await adb[f"{self.bucket}.files"].delete_many({"_id": {"$in": ids}})
+        await adb[f"{self.bucket}.chunks"].delete_many({"files_id": {"$in": ids}})
+        return res.deleted_count
+
+    def list_files(self, after=None, limit=500):
+        filt = {"_id": {"$gt": ObjectId(after)}} if after else {}
+        cur = db[f"{self.bucket}.files"].find(filt, {"uploadDate": 1}).sort("_id", 1).limit(limit)
+        return [(str(f["_id"]), f["uploadDate"].replace(tzinfo=timezone.utc)) for f in cur]
+
+
+class _LocalWriter:
+    """Writes to a temp file next to the target and publishes it atomically on close"""
+
+    def __init__(self, store: "LocalStore", file_id: str, filename: Optional[str], content_type: Optional[str]):
+        self._id = file_id
+        self._meta = {"file_id": file_id, "filename": filename, "content_type": content_type}
+        self._path, self._meta_path = store._paths(file_id)
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        fd, self._tmp = tempfile.mkstemp(dir=os.path.dirname(self._path), prefix=".put-")
+        self._fh = os.fdopen(fd, "wb")
+        self._length = 0
+
+    def write(self, data: bytes):
+        self._fh.write(data)
+        self._length += len(data)
+
+    def close(self):
+        self._fh.close()
+        meta = {**self._meta, "length": self._length, "upload_date": datetime.now(timezone.utc).isoformat()}
+        with open(self._meta_path, "w") as fh:
+            json.dump(meta, fh)
+        os.replace(self._tmp, self._path)
+
+    def abort(self):
+        self._fh.close()
+        if os.path.exists(self._tmp):
+            os.unlink(self._tmp)
+
+
+class LocalStore(BlobStore):
+    """Files under root/<last 2 id chars>/<previous 2>/<id>, with a JSON metadata sidecar"""
+
+    name = "local"
+
+    def __init__(self, root: str = BLOB_LOCAL_DIR):
+        self.root = root
+
+    def _paths(self, file_id: str):
+        # The tail of an ObjectId is a counter, so it spreads files evenly across shards
+        path = os.path.join(self.root, file_id[-2:], file_id[-4:-2], file_id)
+        return path, path + ".json"
+
+    def new_writer(self, filename=None, content_type=None, file_id=None):
+        return _LocalWriter(self, file_id or str(ObjectId()), filename, content_type)
+
+    def open(self, file_id: str) -> FileBlob:
+        path, meta_path = self._paths(file_id)
+        with open(meta_path) as fh:
+            return FileBlob(path, json.load(fh))
+
+    def delete_many(self, file_ids: Iterable[str]) -> int:
+        removed = 0
+        for file_id in file_ids:
+            path, meta_path = self._paths(file_id)
+            try:
+                os.unlink(path)
+                removed += 1
+            except OSError:
+                pass
+            try:
+                os.unlink(meta_path)
+            except OSError:
+                pass
+        return removed
+
+    @staticmethod
+    def _shard_key(file_id: str) -> tuple:
+        return file_id[-2:], file_id[-4:-2], file_id
+
+    @staticmethod
+    def _sorted_dir(path: str, first: Optional[str] = None) -> List[os.DirEntry]:
+        """Entries of path from name `first` on, by name; none if it doesn't exist"""
+        try:
+            with os.scandir(path) as it:
+                entries = [e for e in it if not e.name.startswith(".") and (first is None or e.name >= first)]
+        except FileNotFoundError:
+            return []
+        return sorted(entries, key=lambda e: e.name)
+
+    def list_files(self, after=None, limit=500):
+        """(file_id, upload_date) pairs in shard order (see _paths), starting after `after`.
+
+        Only the shard directories at or past `after` are listed, so a page
+        costs the same wherever it starts.
+        """
+        start = self._shard_key(after) if after else (None, None, None)
+        out = []
+        for top in self._sorted_dir(self.root, start[0]):
+            resume = top.name == start[0]
+            for sub in self._sorted_dir(top.path, start[1] if resume else None):
+                resume_here = resume and sub.name == start[1]
+                for entry in self._sorted_dir(sub.path, start[2] if resume_here else None):
+                    if entry.name.endswith(".json") or (resume_here and entry.name == start[2]):
+                        continue
+                    try:
+                        uploaded = datetime.fromtimestamp(entry.stat().st_mtime, timezone.utc)
+                    except OSError:
+                        continue
+                    out.append((entry.name, uploaded))
+                    if len(out) >= limit:
+                        return out
+        return out
+
+
+STORES: Dict[str, BlobStore] = {"gridfs": GridFSStore(), "local": LocalStore()}
+
+
+def get_store(name: Optional[str] = None) -> BlobStore:
+    """Backend by name; photos saved before backends existed have no name and live in GridFS"""
+    try:
+        return STORES[name or "gridfs"]
+    except KeyError:
+        raise ValueError(f"Unknown blob backend: {name}")
+
+
+def default_store() -> BlobStore:
+    return get_store(BLOB_BACKEND)
+
+
+def photo_storage_filter(name: str) -> dict:
+    if name == "gridfs":
+        return {"$or": [{"storage": "gridfs"}, {"storage": {"$exists": False}}]}
+    return {"storage": name}
+
+
+def copy_blob(src: BlobStore, dst: BlobStore, file_id: str):
+    """Copy one file between backends under the same id, chunk by chunk"""
+    blob = src.open(file_id)
+    writer = dst.new_writer(filename=getattr(blob, "filename", None), content_type=blob.content_type, file_id=file_id)
+    try:
+        while True:
+            chunk = blob.read(_COPY_CHUNK)
+            if not chunk:
+                break
+            writer.write(chunk)
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        blob.close()
+
+
+def migrate(src_name: str, dst_name: str, batch_size: int = 200) -> dict:
+    """Move every photo's files from one backend to another, one batch of photos at a time"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    src, dst = get_store(src_name), get_store(dst_name)
+    moved = 0
+    failed: List[str] = []
+    while True:
+        filt = photo_storage_filter(src.name)
+        if failed:
+            filt = {"$and": [filt, {"_id": {"$nin": [ObjectId(i) for i in failed]}}]}
+        batch = list(db["photo"].find(filt, {"file_id": 1, "derivatives.file_id": 1, "sha256": 1}).limit(batch_size))
+        if not batch:
+            break
+        done, shared, copied = [], [], set()
+        for p in batch:
+            ids = [i for i in [p.get("file_id")] + [d.get("file_id") for d in p.get("derivatives") or []] if i]
+            # Deduplicated photos in one batch share files; copy each once
+            todo = [i for i in ids if i not in copied]
+            try:
+                for file_id in todo:
+                    copy_blob(src, dst, file_id)
+            except Exception as e:
+                logger.warning("photo %s: %s", p["_id"], e)
+                dst.delete_many(todo)
+                failed.append(str(p["_id"]))
+                continue
+            done.append(p["_id"])
+            copied.update(todo)
+            if p.get("sha256"):
+                shared.append(p["sha256"])
+        if done:
+            # Point the photos (and every photo sharing their bytes) at the new backend before dropping the source copies
+            res = db["photo"].update_many({"$or": [{"_id": {"$in": done}}, {"sha256": {"$in": shared}}]}, {"$set": {"storage": dst.name}})
+            if shared:
+                db["blob"].update_many({"_id": {"$in": shared}}, {"$set": {"storage": dst.name}})
+            src.delete_many(list(copied))
+            moved += res.modified_count
+        logger.info("moved %s photos, %s failed", moved, len(failed))
+    return {"moved": moved, "failed": failed}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or sys.argv[1] != "migrate":
+        print(__doc__)
+        sys.exit(2)
+    # Progress goes through the module logger; show it on the terminal
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    result = migrate(sys.argv[2], sys.argv[3], int(sys.argv[4]) if len(sys.argv) > 4 else 200)
+    print(f"moved {result['moved']} photos, {len(result['failed'])} failed", flush=True)
+    sys.exit(1 if result["failed"] else 0)
@@ -0,0 +1,192 @@
+"""
+Blob Responses
+
+Streams stored files (GridOut, or any file-like object with the same
+length/seek/read interface, including storage.AsyncBlob whose reads are
+awaited) with HTTP Range support, so interrupted
+downloads can resume. A range request seeks inside the file and only the
+chunks covering the requested bytes are read.
+
+The bytes stored under a file id never change, so responses carry a strong
+ETag and Last-Modified and answer conditional requests with 304. Whether
+the response may be cached as immutable (until the owning photo expires)
+is the caller's call: a URL that can start serving another file, such as
+an image whose edits change, must be revalidated instead. Files that are
+already on local disk (storage.FileBlob) go out as a FileResponse.
+
+Settings (environment):
+    STREAM_CHUNK_SIZE    bytes per streamed body chunk (default: 255 KiB, one GridFS chunk)
+    IMAGE_CACHE_MAX_AGE  upper bound of Cache-Control max-age in seconds (default: one year)
+"""
+
+import os
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(255 * 1024)))
+IMAGE_CACHE_MAX_AGE = int(os.getenv("IMAGE_CACHE_MAX_AGE", str(365 * 24 * 3600)))
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single 'bytes=' range into inclusive (start, end).
+
+    Returns None when the header should be ignored (other units, multiple
+    ranges, malformed) and the whole file served; raises 416 when the range
+    cannot be satisfied.
+    """
+    units, _, spec = header.partition("=")
+    if units.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "":
+            suffix = int(last)
+            if suffix <= 0:
+                raise ValueError
+            start, end = max(0, size - suffix), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start < 0 or start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+def iter_blob(blob, start: int, length: int, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield `length` bytes of blob from `start`, one chunk at a time"""
+    try:
+        if start:
+            blob.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = blob.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        blob.close()
+
+
+async def aiter_blob(blob, start: int, length: int, chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """iter_blob() for blobs with an awaitable read (storage.AsyncBlob)"""
+    try:
+        if start:
+            blob.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = await blob.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        blob.close()
+
+
+def _utc(dt: datetime) -> datetime:
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
+
+
+def etag_for(blob) -> str:
+    """Strong validator: the stored md5 when GridFS computed one, otherwise the immutable file id"""
+    return f'"{getattr(blob, "md5", None) or blob._id}"'
+
+
+def cache_headers(blob, expires_at: Optional[datetime] = None, immutable: bool = True) -> dict:
+    """Validator and Cache-Control headers; max-age never outlives the photo"""
+    max_age = IMAGE_CACHE_MAX_AGE
+    if expires_at is not None:
+        max_age = max(0, min(max_age, int((_utc(expires_at) - datetime.now(timezone.utc)).total_seconds())))
+    cache_control = f"public, max-age={max_age}, immutable" if immutable else "public, no-cache"
+    headers = {"ETag": etag_for(blob), "Cache-Control": cache_control}
+    if getattr(blob, "upload_date", None):
+        headers["Last-Modified"] = format_datetime(_utc(blob.upload_date).replace(microsecond=0), usegmt=True)
+    return headers
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison: W/"x" matches "x"
+    return etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+
+def not_modified(request: Request, headers: dict) -> bool:
+    """True if the client's cached copy is current (If-None-Match, else If-Modified-Since)"""
+    if "if-none-match" in request.headers:
+        return _etag_matches(request.headers["if-none-match"], headers["ETag"])
+    if "if-modified-since" in request.headers and "Last-Modified" in headers:
+        try:
+            since = parsedate_to_datetime(request.headers["if-modified-since"])
+        except (TypeError, ValueError):
+            return False
+        return parsedate_to_datetime(headers["Last-Modified"]) <= _utc(since)
+    return False
+
+
+def range_allowed(request: Request, headers: dict) -> bool:
+    """If-Range: only honour Range when the client's validator still matches"""
+    if_range = request.headers.get("if-range")
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range.strip() == headers["ETag"]
+    return if_range.strip() == headers.get("Last-Modified")
+
+
+def preferred_type(accept: str, offered: List[str]) -> Optional[str]:
+    """The offered media type the client's Accept header names explicitly with the highest q (ties: order of `offered`).
+
+    Wildcards don't count: browsers send */* without being able to decode
+    every image format.
+    """
+    quality = {}
+    for part in accept.split(","):
+        media_type, *params = (x.strip() for x in part.split(";"))
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        quality[media_type.lower()] = q
+    candidates = [t for t in offered if quality.get(t, 0) > 0]
+    return max(candidates, key=lambda t: quality[t], default=None)
+
+
+def blob_response(request: Request, blob, media_type: Optional[str] = None, expires_at: Optional[datetime] = None, immutable: bool = True, vary: Optional[str] = None) -> Response:
+    """Full (200), partial (206) or 304 response for a stored file, honouring Range and conditional headers"""
+    headers = cache_headers(blob, expires_at, immutable)
+    if vary:
+        headers["Vary"] = vary
+    if not_modified(request, headers):
+        blob.close()
+        return Response(status_code=304, headers=headers)
+    size = blob.length
+    media_type = media_type or blob.content_type or "image/jpeg"
+    headers["Accept-Ranges"] = "bytes"
+    byte_range = None
+    if "range" in request.headers and range_allowed(request, headers):
+        byte_range = parse_range(request.headers["range"], size)
+    body = aiter_blob if getattr(blob, "is_async", False) else iter_blob
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        if getattr(blob, "path", None):
+            blob.close()
+            return FileResponse(blob.path, media_type=media_type, headers=headers)
+        return StreamingResponse(body(blob, 0, size), media_type=media_type, headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(body(blob, start, end - start + 1), status_code=206, media_type=media_type, headers=headers)
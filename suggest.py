@@ -0,0 +1,157 @@
+"""
+Album Suggestions
+
+Autocomplete for the home page search box. Every live album's event name
+and location are kept in process memory as a sorted list of normalized
+keys (case- and accent-folded), one per word suffix, so "wed" finds
+"Smith Wedding" too. A lookup is a bisect to the first key with the prefix
+and a walk over the next few entries; nothing touches MongoDB.
+
+The index is filled on first use and refreshed incrementally: albums
+created by this worker are added as they are created, those created by
+other workers are picked up by a query on created_at at most every
+SUGGEST_REFRESH_SECONDS, and expired albums drop out on the next lookup
+after their expiry.
+
+Settings (environment):
+    SUGGEST_LIMIT            suggestions returned by default (default: 8)
+    SUGGEST_REFRESH_SECONDS  how often new albums of other workers are picked up (default: 30)
+"""
+
+import asyncio
+import bisect
+import heapq
+import os
+import re
+import time
+import unicodedata
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from database import adb
+
+SUGGEST_LIMIT = int(os.getenv("SUGGEST_LIMIT", "8"))
+SUGGEST_REFRESH_SECONDS = float(os.getenv("SUGGEST_REFRESH_SECONDS", "30"))
+
+FIELDS = ("event_name", "location")
+# Albums inserted concurrently can become visible out of created_at order; re-read this far back
+_REFRESH_OVERLAP = timedelta(seconds=60)
+_LOAD_BATCH = 5000
+
+
+def normalize(text: str) -> str:
+    """Case-folded, accents stripped, whitespace collapsed"""
+    if text.isascii():
+        return " ".join(text.casefold().split())
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return " ".join("".join(c for c in decomposed if not unicodedata.combining(c)).split())
+
+
+def _word_suffixes(key: str) -> List[str]:
+    return [key[m.start():] for m in re.finditer(r"\S+", key)]
+
+
+class SuggestIndex:
+    """Sorted prefix index over album event names and locations"""
+
+    def __init__(self, expiry: Callable[[dict], datetime]):
+        self.expiry = expiry
+        self._keys: List[Tuple[str, str, str]] = []  # (key, field, text), sorted
+        self._refs: Dict[Tuple[str, str], int] = {}  # (field, text) -> live albums using it
+        self._albums: Dict[str, List[Tuple[str, str]]] = {}  # album id -> its (field, text) pairs
+        self._expiry: List[Tuple[datetime, str]] = []  # heap of (expires_at, album id)
+        self._seen: Optional[datetime] = None
+        self._refreshed = 0.0
+        self._lock = asyncio.Lock()
+        self.lookups = 0
+
+    def _index(self, album: dict, now: datetime) -> List[Tuple[str, str, str]]:
+        """Register a live album; returns the keys it adds to the index"""
+        album_id = str(album["_id"])
+        expires_at = self.expiry(album)
+        if album_id in self._albums or expires_at <= now:
+            return []
+        keys = []
+        pairs = [(field, album[field].strip()) for field in FIELDS if (album.get(field) or "").strip()]
+        for pair in pairs:
+            self._refs[pair] = self._refs.get(pair, 0) + 1
+            if self._refs[pair] == 1:
+                keys.extend((key, *pair) for key in _word_suffixes(normalize(pair[1])))
+        self._albums[album_id] = pairs
+        heapq.heappush(self._expiry, (expires_at, album_id))
+        return keys
+
+    def add(self, album: dict, now: Optional[datetime] = None):
+        """Index a live album; adding one that is indexed or expired does nothing"""
+        for key in self._index(album, now or datetime.now(timezone.utc)):
+            bisect.insort(self._keys, key)
+
+    def add_many(self, albums: Iterable[dict], now: Optional[datetime] = None):
+        """Index many albums with one sort instead of an insertion per key"""
+        now = now or datetime.now(timezone.utc)
+        keys = [key for album in albums for key in self._index(album, now)]
+        if keys:
+            # Two sorted runs: the sort merges them in linear time
+            keys.sort()
+            self._keys.extend(keys)
+            self._keys.sort()
+
+    def remove(self, album_id: str):
+        for pair in self._albums.pop(album_id, []):
+            self._refs[pair] -= 1
+            if self._refs[pair]:
+                continue
+            del self._refs[pair]
+            for key in _word_suffixes(normalize(pair[1])):
+                entry = (key, *pair)
+                i = bisect.bisect_left(self._keys, entry)
+                if i < len(self._keys) and self._keys[i] == entry:
+                    del self._keys[i]
+
+    def prune(self, now: Optional[datetime] = None) -> int:
+        """Drop albums that have expired; returns how many"""
+        now = now or datetime.now(timezone.utc)
+        removed = 0
+        while self._expiry and self._expiry[0][0] <= now:
+            _, album_id = heapq.heappop(self._expiry)
+            self.remove(album_id)
+            removed += 1
+        return removed
+
+    async def refresh(self, force: bool = False):
+        """Load albums created since the last refresh (all of them the first time)"""
+        if adb is None or (not force and time.monotonic() - self._refreshed < SUGGEST_REFRESH_SECONDS):
+            return
+        async with self._lock:
+            if not force and time.monotonic() - self._refreshed < SUGGEST_REFRESH_SECONDS:
+                return
+            filt = {"created_at": {"$gte": self._seen - _REFRESH_OVERLAP}} if self._seen else {}
+            albums = await adb["album"].find(filt, {"event_name": 1, "location": 1, "created_at": 1, "expires_in_days": 1}).to_list(None)
+            for i in range(0, len(albums), _LOAD_BATCH):
+                self.add_many(albums[i:i + _LOAD_BATCH])
+                # Let requests through between batches of a large first fill
+                await asyncio.sleep(0)
+            created = [a["created_at"] for a in albums if a.get("created_at")]
+            if created:
+                self._seen = max(created + ([self._seen] if self._seen else []))
+            self._refreshed = time.monotonic()
+
+    def suggest(self, prefix: str, limit: int = SUGGEST_LIMIT) -> List[dict]:
+        """Up to limit distinct names and locations with a word starting with prefix, in alphabetical order of the match"""
+        self.lookups += 1
+        self.prune()
+        p = normalize(prefix)
+        if not p:
+            return []
+        out, seen = [], set()
+        for i in range(bisect.bisect_left(self._keys, (p,)), len(self._keys)):
+            key, field, text = self._keys[i]
+            if not key.startswith(p) or len(out) >= limit:
+                break
+            if (field, text) not in seen:
+                seen.add((field, text))
+                out.append({"text": text, "field": field})
+        return out
+
+    def stats(self) -> dict:
+        return {"albums": len(self._albums), "keys": len(self._keys), "lookups": self.lookups}
@@ -0,0 +1,56 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import dedup
+import expiry
+import renditions
+
+
+class RecordingStore:
+    def __init__(self):
+        self.deleted = []
+
+    def delete_many(self, file_ids):
+        self.deleted.extend(file_ids)
+        return len(file_ids)
+
+
+@pytest.fixture
+def env(monkeypatch):
+    db = mongomock.MongoClient()["test"]
+    store = RecordingStore()
+    for module in (expiry, dedup, renditions):
+        monkeypatch.setattr(module, "db", db)
+    monkeypatch.setattr(expiry, "get_store", lambda storage=None: store)
+    return db, store
+
+
+def test_double_purge_releases_shared_blob_once(env):
+    db, store = env
+    db["blob"].insert_one({"_id": "abc", "file_id": "f1", "refs": 2, "storage": "gridfs"})
+    db["photo"].insert_many([
+        {"_id": "p1", "file_id": "f1", "sha256": "abc", "storage": "gridfs"},
+        {"_id": "p2", "file_id": "f1", "sha256": "abc", "storage": "gridfs"},
+    ])
+    photo = {"_id": "p1", "file_id": "f1", "sha256": "abc"}
+
+    # A DELETE and the reaper both picked up p1
+    assert expiry.purge_photos([photo]) == 1
+    assert expiry.purge_photos([photo]) == 0
+
+    assert db["blob"].find_one({"_id": "abc"})["refs"] == 1
+    assert store.deleted == []
+    assert db["photo"].find_one({"_id": "p2"}) is not None
+
+
+def test_last_reference_deletes_the_file(env):
+    db, store = env
+    db["blob"].insert_one({"_id": "abc", "file_id": "f1", "refs": 1, "storage": "gridfs"})
+    db["photo"].insert_one({"_id": "p1", "file_id": "f1", "sha256": "abc", "storage": "gridfs"})
+    db["photo"].insert_one({"_id": "p2", "file_id": "f2", "storage": "gridfs"})
+
+    assert expiry.purge_photos([{"_id": "p1"}, {"_id": "p2"}]) == 2
+
+    assert db["blob"].find_one({"_id": "abc"}) is None
+    assert sorted(store.deleted) == ["f1", "f2"]
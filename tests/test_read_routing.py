@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+import database
+
+
+class FakeCollection:
+    """Stand-in for a Motor collection on one replica set member"""
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = 0
+
+    async def find_one(self, filt, *args, **kwargs):
+        self.queries += 1
+        return next((d for d in self.docs if all(d.get(k) == v for k, v in filt.items())), None)
+
+
+class FakeDatabase:
+    def __init__(self, **collections):
+        self.collections = {name: FakeCollection(docs) for name, docs in collections.items()}
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection([]))
+
+
+@pytest.fixture
+def handles(monkeypatch):
+    def install(primary, secondary):
+        monkeypatch.setattr(database, "adb", primary)
+        monkeypatch.setattr(database, "adb_public", secondary)
+        return primary, secondary
+    return install
+
+
+def test_public_find_one_reads_from_secondary(handles):
+    primary, secondary = handles(FakeDatabase(album=[{"_id": 1, "v": "primary"}]), FakeDatabase(album=[{"_id": 1, "v": "secondary"}]))
+    assert asyncio.run(database.public_find_one("album", {"_id": 1}))["v"] == "secondary"
+    assert primary["album"].queries == 0
+
+
+def test_public_find_one_retries_miss_on_primary(handles):
+    # Written a moment ago: on the primary, not yet replicated
+    primary, secondary = handles(FakeDatabase(album=[{"_id": 1}]), FakeDatabase(album=[]))
+    assert asyncio.run(database.public_find_one("album", {"_id": 1})) == {"_id": 1}
+    assert secondary["album"].queries == 1
+    assert primary["album"].queries == 1
+
+
+def test_public_find_one_missing_everywhere(handles):
+    handles(FakeDatabase(album=[]), FakeDatabase(album=[]))
+    assert asyncio.run(database.public_find_one("album", {"_id": 1})) is None
+
+
+def test_public_find_one_single_handle_queries_once(handles):
+    # Primary read preference (or a standalone server): one handle, no retry
+    db = FakeDatabase(album=[])
+    handles(db, db)
+    assert asyncio.run(database.public_find_one("album", {"_id": 1})) is None
+    assert db["album"].queries == 1
+
+
+def test_listings_read_through_current_public_handle(handles):
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    import main
+
+    primary = mongomock_motor.AsyncMongoMockClient()["primary"]
+    secondary = mongomock_motor.AsyncMongoMockClient()["secondary"]
+    handles(primary, secondary)
+
+    async def run():
+        await primary["album"].insert_one({"event_name": "New", "expires_in_days": 15})
+        await secondary["album"].insert_one({"event_name": "Replicated", "expires_in_days": 15})
+        return await main.query_albums("", None, None, 60)
+
+    assert [a["event_name"] for a in asyncio.run(run())] == ["Replicated"]
@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import reaper as reaper_module
+from reaper import Reaper
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = mongomock.MongoClient()["test"]
+    monkeypatch.setattr(reaper_module, "db", db)
+    monkeypatch.setattr(reaper_module, "cleanup_expired", lambda batch_size, time_budget: {"removed": 1, "complete": True})
+    return db
+
+
+def test_one_reaper_holds_the_lease(db):
+    first, second = Reaper(mode="reaper"), Reaper(mode="reaper")
+
+    assert first.run_once()["removed"] == 1
+    assert second.run_once()["skipped"]
+    assert first.run_once()["removed"] == 1  # the holder renews
+    assert (first.runs, second.runs, second.skipped) == (2, 0, 1)
+
+    first.release()
+    assert second.run_once()["removed"] == 1
+    assert db["lease"].find_one({"_id": "reaper"})["owner"] == second.owner
+
+
+def test_expired_lease_is_taken_over(db):
+    first, second = Reaper(mode="reaper"), Reaper(mode="reaper")
+    first.run_once()
+    db["lease"].update_one({"_id": "reaper"}, {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}})
+
+    assert second.run_once()["removed"] == 1
+    assert first.run_once()["skipped"]
+    assert not first.holds_lease
+
+
+def test_forced_run_ignores_the_lease(db):
+    first, second = Reaper(mode="reaper"), Reaper(mode="reaper")
+    first.run_once()
+
+    assert second.run_once(force=True)["removed"] == 1
+    assert db["lease"].find_one({"_id": "reaper"})["owner"] == first.owner
@@ -0,0 +1,61 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+import renditions
+from images import DERIVATIVE_SIZES
+
+SIZE = next(iter(DERIVATIVE_SIZES))
+
+
+def test_missing_jpeg_derivative_is_rendered():
+    p = {"_id": "p1", "file_id": "f1", "derivatives": []}
+    spec = renditions._render_spec(p, SIZE, None)
+    assert spec == {"size": SIZE, "edits": {}}
+
+
+def test_stored_jpeg_derivative_is_served():
+    p = {"_id": "p1", "file_id": "f1", "derivatives": [{"name": SIZE, "file_id": "d1", "content_type": "image/jpeg"}]}
+    assert renditions._render_spec(p, SIZE, None) is None
+    assert renditions._render_spec(p, None, None) is None
+    assert renditions.photo_file_id(p, SIZE) == "d1"
+
+
+class FakeEngine:
+    def __init__(self):
+        self.runs = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        yield None
+
+    async def run(self, fn, *args, slot=None):
+        self.runs += 1
+        return fn(*args)
+
+
+def test_non_image_is_decoded_once(monkeypatch):
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    adb = mongomock_motor.AsyncMongoMockClient()["test"]
+    engine = FakeEngine()
+
+    async def read_source(file_id, storage, cached=True):
+        return b"not an image"
+
+    monkeypatch.setattr(renditions, "adb", adb)
+    monkeypatch.setattr(renditions, "image_engine", engine)
+    monkeypatch.setattr(renditions, "_read_source", read_source)
+    p = {"_id": "p1", "file_id": "f1", "watermark": True}
+
+    async def scenario():
+        first = await renditions.resolve(p)
+        second = await renditions.resolve(p)
+        found = await renditions.lookup([p])
+        return first, second, found
+
+    first, second, found = asyncio.run(scenario())
+    assert first is None and second is None
+    assert engine.runs == 1
+    # Served as is, like resolve does: not left pending for a render that can't succeed
+    assert found == [(False, None)]
@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta, timezone
+
+import responsecache
+from responsecache import ResponseCache
+
+
+def test_hit_after_put():
+    cache = ResponseCache(ttl=30, max_entries=4)
+    assert cache.get("k") is None
+    cache.put("k", [1], cache.generation)
+    assert cache.get("k") == [1]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_lru_eviction():
+    cache = ResponseCache(ttl=30, max_entries=2)
+    cache.put("a", 1, cache.generation)
+    cache.put("b", 2, cache.generation)
+    cache.get("a")  # b is now least recently used
+    cache.put("c", 3, cache.generation)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_invalidate_drops_entries_and_stale_puts():
+    cache = ResponseCache(ttl=30, max_entries=4)
+    cache.put("a", 1, cache.generation)
+    started = cache.generation  # a query begins...
+    cache.invalidate()  # ...a write lands...
+    cache.put("b", 2, started)  # ...and the query's result is out of date
+    assert cache.get("a") is None and cache.get("b") is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_ttl(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(responsecache.time, "monotonic", lambda: clock[0])
+    cache = ResponseCache(ttl=30, max_entries=4)
+    cache.put("a", 1, cache.generation)
+    clock[0] += 29
+    assert cache.get("a") == 1
+    clock[0] += 2
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_valid_until():
+    cache = ResponseCache(ttl=30, max_entries=4)
+    now = datetime.now(timezone.utc)
+    cache.put("gone", 1, cache.generation, valid_until=now - timedelta(seconds=1))
+    cache.put("live", 2, cache.generation, valid_until=now + timedelta(hours=1))
+    assert cache.get("gone") is None
+    assert cache.get("live") == 2
+
+
+def test_disabled():
+    cache = ResponseCache(ttl=0, max_entries=4)
+    cache.put("a", 1, cache.generation)
+    assert not cache.enabled
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
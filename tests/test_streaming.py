@@ -0,0 +1,59 @@
+import pytest
+from fastapi import HTTPException
+
+from streaming import parse_range, range_allowed
+
+SIZE = 1000
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=990-5000", (990, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("BYTES = 5-5", (5, 5)),
+])
+def test_satisfiable_ranges(header, expected):
+    assert parse_range(header, SIZE) == expected
+
+
+@pytest.mark.parametrize("header", [
+    "bytes=0-10,20-30",  # multiple ranges: whole body instead
+    "items=0-10",
+    "bytes=abc",
+    "bytes=1-x",
+    "bytes=-0",
+    "bytes=",
+])
+def test_ignored_ranges(header):
+    assert parse_range(header, SIZE) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=2000-3000", "bytes=50-10"])
+def test_unsatisfiable_ranges(header):
+    with pytest.raises(HTTPException) as e:
+        parse_range(header, SIZE)
+    assert e.value.status_code == 416
+    assert e.value.headers["Content-Range"] == f"bytes */{SIZE}"
+
+
+class FakeRequest:
+    def __init__(self, **headers):
+        self.headers = {k.replace("_", "-"): v for k, v in headers.items()}
+
+
+HEADERS = {"ETag": '"abc"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT"}
+
+
+@pytest.mark.parametrize("if_range, allowed", [
+    (None, True),
+    ('"abc"', True),
+    ('"old"', False),
+    ('W/"abc"', False),  # weak validators never satisfy If-Range
+    ("Mon, 01 Jan 2024 00:00:00 GMT", True),
+    ("Sun, 31 Dec 2023 00:00:00 GMT", False),
+])
+def test_if_range(if_range, allowed):
+    request = FakeRequest(**({"if_range": if_range} if if_range else {}))
+    assert range_allowed(request, HEADERS) is allowed
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta, timezone
+
+from suggest import SuggestIndex
+
+# suggest() prunes against the clock, so the albums must be live now
+NOW = datetime.now(timezone.utc)
+
+
+def album(album_id, event_name, location="", days=30):
+    return {"_id": album_id, "event_name": event_name, "location": location, "expires_at": NOW + timedelta(days=days)}
+
+
+def make_index(*albums):
+    index = SuggestIndex(lambda a: a["expires_at"])
+    index.add_many(albums, now=NOW)
+    return index
+
+
+def texts(index, prefix, limit=8):
+    return [s["text"] for s in index.suggest(prefix, limit)]
+
+
+def test_mid_word_and_accent_folded_prefixes():
+    index = make_index(album("a1", "Smith Wedding", "Café de Flore"))
+    assert texts(index, "wed") == ["Smith Wedding"]
+    assert texts(index, "SMI") == ["Smith Wedding"]
+    assert texts(index, "cafe") == ["Café de Flore"]
+    assert texts(index, "flo") == ["Café de Flore"]
+    # Prefixes of words only, not arbitrary substrings
+    assert texts(index, "edding") == []
+
+
+def test_shared_location_outlives_the_first_album():
+    index = make_index(album("a1", "Smith Wedding", "Lisbon", days=1), album("a2", "Jones Party", "Lisbon", days=10))
+    assert index.suggest("lis") == [{"text": "Lisbon", "field": "location"}]
+
+    assert index.prune(NOW + timedelta(days=2)) == 1
+    assert index.suggest("lis") == [{"text": "Lisbon", "field": "location"}]
+    assert texts(index, "smi") == []
+
+    assert index.prune(NOW + timedelta(days=11)) == 1
+    assert texts(index, "lis") == []
+    assert index.stats()["keys"] == 0
+
+
+def test_expired_and_duplicate_albums_are_not_indexed():
+    index = make_index(album("a1", "Old Gala", days=-1))
+    index.add(album("a2", "Spring Gala"), now=NOW)
+    index.add(album("a2", "Spring Gala"), now=NOW)
+    assert texts(index, "gala") == ["Spring Gala"]
+    assert index.stats()["albums"] == 1
+
+
+def test_limit_and_order():
+    index = make_index(*(album(f"a{i}", f"Party {name}") for i, name in enumerate(["Delta", "Alpha", "Charlie", "Bravo"])))
+    assert texts(index, "party", limit=2) == ["Party Alpha", "Party Bravo"]
+    assert len(index.suggest("party")) == 4
+    assert index.suggest("   ") == []
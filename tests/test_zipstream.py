@@ -0,0 +1,74 @@
+import functools
+import io
+import zipfile
+import zlib
+from datetime import datetime
+
+import pytest
+
+from zipstream import ZipEntry, ZipStream
+
+FILES = [
+    ("a.jpg", b"first photo" * 1000),
+    ("dir/b.png", bytes(range(256)) * 300),
+    ("empty.txt", b""),
+    ("ünïcode.jpg", b"x" * 12345),
+]
+
+
+def entries(known_crc: bool):
+    return [
+        ZipEntry(
+            name=name, size=len(data), mtime=datetime(2024, 5, 6, 7, 8, 10),
+            open=functools.partial(io.BytesIO, data), crc32=zlib.crc32(data) if known_crc else None, key=name,
+        )
+        for name, data in FILES
+    ]
+
+
+@pytest.mark.parametrize("known_crc", [True, False])
+def test_archive_reads_back(known_crc):
+    archive = ZipStream(entries(known_crc))
+    body = b"".join(archive)
+    assert len(body) == archive.size
+    zf = zipfile.ZipFile(io.BytesIO(body))
+    assert zf.testzip() is None
+    assert [(i.filename, zf.read(i)) for i in zf.infolist()] == FILES
+    assert zf.getinfo("a.jpg").date_time == (2024, 5, 6, 7, 8, 10)
+
+
+def test_seekable_only_with_every_crc():
+    assert ZipStream(entries(True)).seekable
+    assert not ZipStream(entries(False)).seekable
+    with pytest.raises(ValueError):
+        list(ZipStream(entries(False)).iter_range(0, 10))
+
+
+def test_ranges_match_full_body():
+    archive = ZipStream(entries(True))
+    body = b"".join(archive)
+    cuts = sorted({0, 1, 29, 30, archive.offsets[1] - 1, archive.offsets[1], archive.offsets[1] + 5, archive.cd_offset - 1, archive.cd_offset, archive.size - 22, archive.size - 1})
+    for start in cuts:
+        for end in cuts:
+            if end >= start:
+                assert b"".join(archive.iter_range(start, end)) == body[start:end + 1], (start, end)
+
+
+def test_etag_follows_manifest():
+    assert ZipStream(entries(True)).etag() == ZipStream(entries(True)).etag()
+    changed = entries(True)
+    changed[0].key = "another file"
+    assert ZipStream(changed).etag() != ZipStream(entries(True)).etag()
+
+
+def test_old_mtime_is_clamped_to_dos_epoch():
+    entry = ZipEntry(name="old.jpg", size=3, mtime=datetime(1970, 1, 1), open=functools.partial(io.BytesIO, b"old"), crc32=zlib.crc32(b"old"))
+    zf = zipfile.ZipFile(io.BytesIO(b"".join(ZipStream([entry]))))
+    assert zf.getinfo("old.jpg").date_time == (1980, 1, 1, 0, 0, 0)
+    assert zf.read("old.jpg") == b"old"
+
+
+def test_short_stored_file_fails():
+    entry = ZipEntry(name="short.jpg", size=10, mtime=datetime(2024, 1, 1), open=functools.partial(io.BytesIO, b"abc"), crc32=0)
+    with pytest.raises(IOError):
+        b"".join(ZipStream([entry]))
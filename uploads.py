@@ -0,0 +1,139 @@
+"""
+Upload Ingest
+
+Streams an UploadFile to a temporary spool file chunk by chunk instead of
+reading it whole, so peak memory per upload is bounded by UPLOAD_CHUNK_SIZE
+rather than the file size. Bytes are hashed as they stream (SHA-256 for
+deduplication, CRC-32 for album ZIP downloads, see zipstream.py).
+
+An upload whose hash is already stored reuses that copy (see dedup.py):
+nothing is written to storage and no image processing runs. Otherwise the
+spool is copied into storage while the image pipeline reads it by path in
+a worker process.
+
+Multi-file uploads run store_upload for up to UPLOAD_CONCURRENCY files at
+once; image work is further bounded by the image engine's queue.
+
+Settings (environment):
+    UPLOAD_CHUNK_SIZE   bytes read from the request per step (default: 1 MiB)
+    UPLOAD_CONCURRENCY  files of one request stored in parallel (default: 8)
+"""
+
+import asyncio
+import hashlib
+import os
+import tempfile
+import zlib
+from typing import Optional
+
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+
+import dedup
+from expiry import adelete_files
+from image_engine import image_engine
+from images import render_derivatives
+from storage import BlobStore
+
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "8"))
+
+
+async def ingest_upload(f: UploadFile) -> dict:
+    """Stream one upload into a temp spool file, hashing it on the way.
+
+    Returns size, sha256, crc32 and path (the spool file; the caller removes it).
+    """
+    spool = tempfile.NamedTemporaryFile(prefix="upload-", delete=False)
+    digest = hashlib.sha256()
+    crc = 0
+
+    def spool_write(chunk: bytes):
+        nonlocal crc
+        spool.write(chunk)
+        digest.update(chunk)
+        crc = zlib.crc32(chunk, crc)
+
+    size = 0
+    try:
+        while True:
+            chunk = await f.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            await run_in_threadpool(spool_write, chunk)
+            size += len(chunk)
+        spool.close()
+    except BaseException:
+        spool.close()
+        os.unlink(spool.name)
+        raise
+    return {"size": size, "sha256": digest.hexdigest(), "crc32": crc, "path": spool.name}
+
+
+async def store_spool(path: str, store: BlobStore, filename: Optional[str], content_type: Optional[str]) -> str:
+    """Copy a spooled upload into a new stored file, chunk by chunk; returns its id"""
+    writer = await store.anew_writer(filename=filename, content_type=content_type)
+    try:
+        with open(path, "rb") as fh:
+            while True:
+                chunk = await run_in_threadpool(fh.read, UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await writer.write(chunk)
+        await writer.close()
+    except BaseException:
+        await writer.abort()
+        raise
+    return str(writer._id)
+
+
+async def store_upload(f: UploadFile, store: BlobStore) -> dict:
+    """Ingest one upload and reuse identical stored bytes, or store it and its derivatives.
+
+    Returns file_id, storage, size, sha256, crc32 and derivatives, with a blob
+    reference taken for the caller's photo; on failure nothing stays behind
+    in storage.
+    """
+    upload = await ingest_upload(f)
+    try:
+        return await _store_spooled(upload, f, store)
+    finally:
+        os.unlink(upload["path"])
+
+
+async def _store_spooled(upload: dict, f: UploadFile, store: BlobStore) -> dict:
+    shared = {"size": upload["size"], "crc32": upload["crc32"], "sha256": upload["sha256"]}
+    existing = await dedup.claim(upload["sha256"])
+    if existing is not None:
+        # Already stored: nothing is written
+        return {**shared, "file_id": existing["file_id"], "storage": existing["storage"], "derivatives": existing["derivatives"]}
+
+    # Storage write and image processing overlap
+    file_id, rendered = await asyncio.gather(
+        store_spool(upload["path"], store, f.filename, f.content_type),
+        image_engine.run(render_derivatives, upload["path"]),
+        return_exceptions=True,
+    )
+    for failure in (file_id, rendered):
+        if isinstance(failure, BaseException):
+            if not isinstance(file_id, BaseException):
+                await adelete_files([file_id], store.name)
+            raise failure
+
+    derivatives = []
+    try:
+        for d in rendered:
+            d_id = await store.aput(d.pop("data"), filename=f"{d['name']}/{f.filename}", content_type=d["content_type"])
+            derivatives.append({**d, "file_id": str(d_id)})
+        registered = await dedup.register(upload["sha256"], file_id, store.name, upload["size"], derivatives)
+    except BaseException:
+        await adelete_files([file_id] + [d["file_id"] for d in derivatives], store.name)
+        raise
+    if not registered:
+        # An identical upload registered first: share its copy. If that blob is being released, keep ours unshared.
+        existing = await dedup.claim(upload["sha256"])
+        if existing is None:
+            return {**shared, "file_id": file_id, "storage": store.name, "sha256": None, "derivatives": derivatives}
+        await adelete_files([file_id] + [d["file_id"] for d in derivatives], store.name)
+        return {**shared, "file_id": existing["file_id"], "storage": existing["storage"], "derivatives": existing["derivatives"]}
+    return {**shared, "file_id": file_id, "storage": store.name, "derivatives": derivatives}
@@ -0,0 +1,165 @@
+"""
+Streaming ZIP Archives
+
+Builds a ZIP64 archive of stored files on the fly, with entries stored
+(not recompressed) so bytes go straight from blob reads to the wire and
+memory stays flat however large the album is. Only the per-entry manifest
+(name, size, CRC) is held in memory.
+
+Because entries are stored uncompressed, the archive's exact layout and
+size are known up front. When every entry's CRC-32 is known as well (it is
+recorded at upload), any byte range of the archive can be produced by
+seeking into the right blob, so downloads can resume. Entries without a
+CRC are streamed with a trailing data descriptor instead; the size is
+still exact but the archive can only be produced from the start.
+"""
+
+import hashlib
+import json
+import struct
+import zlib
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Iterator, List, Optional, Tuple
+
+CHUNK_SIZE = 255 * 1024
+
+_VERSION = 45  # ZIP64
+_FLAG_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+_U32 = 0xFFFFFFFF
+_U16 = 0xFFFF
+
+
+@dataclass
+class ZipEntry:
+    name: str
+    size: int
+    mtime: datetime
+    open: Callable  # returns a GridOut-like blob (seek/read/close)
+    crc32: Optional[int] = None
+    key: str = ""  # identifies the entry's bytes (e.g. a file id), for validators
+
+
+def _dos_time(dt: datetime) -> Tuple[int, int]:
+    if dt.year < 1980:
+        return 0, (0 << 9) | (1 << 5) | 1
+    return (dt.hour << 11) | (dt.minute << 5) | (dt.second // 2), ((dt.year - 1980) << 9) | (dt.month << 5) | dt.day
+
+
+def _flags(entry: ZipEntry) -> int:
+    return _FLAG_UTF8 | (_FLAG_DESCRIPTOR if entry.crc32 is None else 0)
+
+
+def _local_header(entry: ZipEntry) -> bytes:
+    name = entry.name.encode("utf-8")
+    extra = struct.pack("<HHQQ", 0x0001, 16, entry.size, entry.size)
+    t, d = _dos_time(entry.mtime)
+    return struct.pack(
+        "<IHHHHHIIIHH", 0x04034B50, _VERSION, _flags(entry), 0, t, d,
+        entry.crc32 or 0, _U32, _U32, len(name), len(extra),
+    ) + name + extra
+
+
+def _descriptor(crc: int, size: int) -> bytes:
+    return struct.pack("<IIQQ", 0x08074B50, crc, size, size)
+
+
+_DESCRIPTOR_SIZE = 24
+
+
+def _central_directory(entries: List[ZipEntry], offsets: List[int], crcs: List[int], cd_offset: int) -> bytes:
+    parts = []
+    for entry, offset, crc in zip(entries, offsets, crcs):
+        name = entry.name.encode("utf-8")
+        extra = struct.pack("<HHQQQ", 0x0001, 24, entry.size, entry.size, offset)
+        t, d = _dos_time(entry.mtime)
+        parts.append(struct.pack(
+            "<IHHHHHHIIIHHHHHII", 0x02014B50, _VERSION, _VERSION, _flags(entry), 0, t, d,
+            crc, _U32, _U32, len(name), len(extra), 0, 0, 0, 0, _U32,
+        ) + name + extra)
+    cd = b"".join(parts)
+    zip64_eocd_offset = cd_offset + len(cd)
+    n = len(entries)
+    zip64_eocd = struct.pack("<IQHHIIQQQQ", 0x06064B50, 44, _VERSION, _VERSION, 0, 0, n, n, len(cd), cd_offset)
+    locator = struct.pack("<IIQI", 0x07064B50, 0, zip64_eocd_offset, 1)
+    eocd = struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, _U16, _U16, _U32, _U32, 0)
+    return cd + zip64_eocd + locator + eocd
+
+
+def _central_directory_size(entries: List[ZipEntry]) -> int:
+    return sum(46 + len(e.name.encode("utf-8")) + 28 for e in entries) + 56 + 20 + 22
+
+
+class ZipStream:
+    """A ZIP64 archive of stored entries whose size is known before any data is read"""
+
+    def __init__(self, entries: List[ZipEntry]):
+        self.entries = entries
+        self.offsets = []
+        offset = 0
+        for entry in entries:
+            self.offsets.append(offset)
+            offset += len(_local_header(entry)) + entry.size + (_DESCRIPTOR_SIZE if entry.crc32 is None else 0)
+        self.cd_offset = offset
+        self.size = offset + _central_directory_size(entries)
+        self.seekable = all(e.crc32 is not None for e in entries)
+
+    def etag(self) -> str:
+        """Strong validator: the archive's bytes follow entirely from its manifest"""
+        manifest = [(e.name, e.key, e.size, e.crc32, e.mtime.isoformat()) for e in self.entries]
+        return f'"{hashlib.sha1(json.dumps(manifest).encode()).hexdigest()}"'
+
+    def _read_entry(self, entry: ZipEntry, start: int, length: int, crc: Optional[list] = None) -> Iterator[bytes]:
+        blob = entry.open()
+        try:
+            if start:
+                blob.seek(start)
+            remaining = length
+            while remaining > 0:
+                data = blob.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    raise IOError(f"{entry.name}: stored file is shorter than recorded")
+                if crc is not None:
+                    crc[0] = zlib.crc32(data, crc[0])
+                remaining -= len(data)
+                yield data
+        finally:
+            blob.close()
+
+    def __iter__(self) -> Iterator[bytes]:
+        """The whole archive, computing missing CRCs on the way"""
+        crcs = []
+        for entry in self.entries:
+            yield _local_header(entry)
+            if entry.crc32 is None:
+                crc = [0]
+                yield from self._read_entry(entry, 0, entry.size, crc)
+                yield _descriptor(crc[0], entry.size)
+                crcs.append(crc[0])
+            else:
+                yield from self._read_entry(entry, 0, entry.size)
+                crcs.append(entry.crc32)
+        yield _central_directory(self.entries, self.offsets, crcs, self.cd_offset)
+
+    def iter_range(self, start: int, end: int) -> Iterator[bytes]:
+        """Bytes start..end (inclusive) of the archive; needs every CRC up front (self.seekable)"""
+        if not self.seekable:
+            raise ValueError("archive has entries without a known CRC")
+        segments = []
+        for entry, offset in zip(self.entries, self.offsets):
+            header = _local_header(entry)
+            segments.append((offset, header))
+            segments.append((offset + len(header), entry))
+        segments.append((self.cd_offset, None))
+
+        bounds = [s[0] for s in segments[1:]] + [self.size]
+        for (seg_start, payload), seg_end in zip(segments, bounds):
+            if seg_end <= start or seg_start > end:
+                continue
+            lo, hi = max(start, seg_start) - seg_start, min(end + 1, seg_end) - seg_start
+            if isinstance(payload, ZipEntry):
+                yield from self._read_entry(payload, lo, hi - lo)
+            else:
+                data = payload if payload is not None else _central_directory(self.entries, self.offsets, [e.crc32 for e in self.entries], self.cd_offset)
+                yield data[lo:hi]